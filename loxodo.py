@@ -24,36 +24,45 @@ from __future__ import print_function
 import sys
 import os
 import platform
+import multiprocessing
 
 from src.config import config
 
-# store base script name, taking special care if we're "frozen" using py2app or py2exe
-if hasattr(sys,"frozen") and (sys.platform != 'darwin'):
-    config.set_basescript(sys.executable)
-else:
-    config.set_basescript(__file__)
-
-# If cmdline arguments were given, use the "cmdline" frontend.
-if len(sys.argv) > 1:
-    from src.frontends.cmdline import loxodo
-    sys.exit()
-
-# In all other cases, use the "wx" frontend.
-try:
-    import wx
-    assert(wx.__version__.startswith('4.0.'))
-except AssertionError as e:
-    print('Found incompatible wxPython, the wxWidgets Python bindings: %s' % wx.__version__, file=sys.stderr)
-    print('Falling back to cmdline frontend.', file=sys.stderr)
-    print('', file=sys.stderr)
-    from src.frontends.cmdline import loxodo
-    sys.exit()
-except ImportError as e:
-    print('Could not find wxPython, the wxWidgets Python bindings: %s' % e, file=sys.stderr)
-    print('Falling back to cmdline frontend.', file=sys.stderr)
-    print('', file=sys.stderr)
-    from src.frontends.cmdline import loxodo
-    sys.exit()
-
-from src.frontends.wx import loxodo
 
+def main():
+    # store base script name, taking special care if we're "frozen" using py2app or py2exe
+    if hasattr(sys,"frozen") and (sys.platform != 'darwin'):
+        config.set_basescript(sys.executable)
+    else:
+        config.set_basescript(__file__)
+
+    # If cmdline arguments were given, use the "cmdline" frontend.
+    if len(sys.argv) > 1:
+        from src.frontends.cmdline import loxodo
+        sys.exit()
+
+    # In all other cases, use the "wx" frontend.
+    try:
+        import wx
+        assert(wx.__version__.startswith('4.0.'))
+    except AssertionError as e:
+        print('Found incompatible wxPython, the wxWidgets Python bindings: %s' % wx.__version__, file=sys.stderr)
+        print('Falling back to cmdline frontend.', file=sys.stderr)
+        print('', file=sys.stderr)
+        from src.frontends.cmdline import loxodo
+        sys.exit()
+    except ImportError as e:
+        print('Could not find wxPython, the wxWidgets Python bindings: %s' % e, file=sys.stderr)
+        print('Falling back to cmdline frontend.', file=sys.stderr)
+        print('', file=sys.stderr)
+        from src.frontends.cmdline import loxodo
+        sys.exit()
+
+    from src.frontends.wx import loxodo
+
+
+# Decryption workers (see $LOXODO_DECRYPT_WORKERS) may be started by re-importing this script,
+# which must then not start a frontend of its own.
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,186 @@
+#
+# Loxodo -- Password Safe V3 compatible Password Vault
+# Copyright (C) 2008 Christoph Sommer <mail@christoph-sommer.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+"""
+Time and memory needed to open, read and save vaults of various sizes.
+
+A vault with the given number of records is written to a temporary directory
+and opened again. Memory is measured with tracemalloc, where available: the
+per-record overhead is the memory held by the opened Vault, minus the raw
+field values themselves and the memory held by an empty Vault (the cipher's
+tables and the like). Both are opened once beforehand, so that one-off imports
+are not counted either. Going through the file with Vault.iter_records() is
+timed, and its peak memory use measured, as is copying it to a new file with
+a VaultWriter. Results are printed as JSON.
+
+Usage:
+    python -m src.bench [--records 1000,100000] [--output FILE]
+"""
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from .vault import Vault, VaultWriter
+
+DEFAULT_RECORDS = "1000,20000"
+
+PASSWORD = u"bench"
+
+
+def make_vault(filename, count):
+    """
+    Write a vault of count records with typical field lengths to the given file.
+    """
+    vault = Vault(PASSWORD)
+    for i in range(count):
+        record = Vault.Record.create()
+        record.group = u"Group %d" % (i % 16)
+        record.title = u"Title %d" % i
+        record.user = u"user%d@example.com" % i
+        record.passwd = u"p4ssw0rd-%08d" % i
+        record.url = u"https://www.example.com/login/%d" % i
+        record.notes = u"Note line for record %d. " % i * (i % 4)
+        vault.records.append(record)
+    vault.write_to_file(filename, PASSWORD)
+
+
+def raw_bytes(vault):
+    """
+    Return the total length of all raw field values of a vault's records.
+    """
+    return sum(field.raw_len for record in vault.records for field in record.raw_fields.values())
+
+
+def empty_vault_bytes(directory, warm_up_filename):
+    """
+    Return the memory held by an opened vault without records, after opening both it and the given vault to warm up.
+    """
+    empty_filename = os.path.join(directory, "bench0.psafe3")
+    make_vault(empty_filename, 0)
+    Vault(PASSWORD, filename=warm_up_filename)
+    Vault(PASSWORD, filename=empty_filename)
+    tracemalloc.start()
+    vault = Vault(PASSWORD, filename=empty_filename)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del vault
+    return held
+
+
+def bench_vault(directory, count):
+    """
+    Return timings and memory use for a vault of count records.
+    """
+    filename = os.path.join(directory, "bench%d.psafe3" % count)
+    make_vault(filename, count)
+    results = {"file_bytes": os.path.getsize(filename)}
+    if tracemalloc is not None:
+        empty_bytes = empty_vault_bytes(directory, filename)
+        tracemalloc.start()
+    start = time.time()
+    vault = Vault(PASSWORD, filename=filename)
+    results["open_seconds"] = time.time() - start
+    if tracemalloc is not None:
+        (held, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results["open_bytes"] = held
+        results["open_peak_bytes"] = peak
+        results["overhead_bytes_per_record"] = (held - empty_bytes - raw_bytes(vault)) / float(count)
+
+    start = time.time()
+    for record in Vault.iter_records(filename, PASSWORD):
+        pass
+    results["stream_seconds"] = time.time() - start
+    if tracemalloc is not None:
+        # in a second pass, as tracing slows down the many small allocations a lot
+        tracemalloc.start()
+        for record in Vault.iter_records(filename, PASSWORD):
+            pass
+        results["stream_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    copy_filename = os.path.join(directory, "copy%d.psafe3" % count)
+    start = time.time()
+    with VaultWriter(copy_filename, PASSWORD) as writer:
+        writer.write_records(Vault.iter_records(filename, PASSWORD))
+    results["stream_copy_seconds"] = time.time() - start
+    if tracemalloc is not None:
+        tracemalloc.start()
+        with VaultWriter(copy_filename, PASSWORD) as writer:
+            writer.write_records(Vault.iter_records(filename, PASSWORD))
+        results["stream_copy_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    start = time.time()
+    for record in vault.records:
+        (record.uuid, record.group, record.title, record.user, record.passwd, record.url, record.notes, record.last_mod)
+    results["read_all_seconds"] = time.time() - start
+
+    start = time.time()
+    vault.write_to_file(filename, PASSWORD)
+    results["save_seconds"] = time.time() - start
+    return results
+
+
+def run(counts):
+    """
+    Run all benchmarks and return the results as a dict.
+    """
+    results = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "vaults": {},
+    }
+    directory = tempfile.mkdtemp()
+    try:
+        for count in counts:
+            results["vaults"][str(count)] = bench_vault(directory, count)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def main(argv):
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-r", "--records", dest="records", default=DEFAULT_RECORDS, help="comma-separated numbers of records to benchmark [default: %default]")
+    parser.add_option("-o", "--output", dest="output", default=None, help="write JSON results to FILE instead of stdout", metavar="FILE")
+    (options, args) = parser.parse_args(argv)
+
+    results = run([int(count) for count in options.records.split(",")])
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as filehandle:
+            filehandle.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
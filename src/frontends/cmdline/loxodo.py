@@ -19,6 +19,7 @@
 
 import os
 import sys
+import time
 from optparse import OptionParser
 from getpass import getpass
 import readline
@@ -68,6 +69,38 @@ class InteractiveConsole(cmd.Cmd):
 
         return p
 
+    def show_info(self):
+        """
+        Print metadata of the Vault file, without decrypting its records.
+        """
+        print("Reading " + self.vault_file_name + "...", file=sys.stderr)
+        try:
+            password = self._getpass("Vault password: ")
+        except EOFError:
+            print("\n\nBye.")
+            raise RuntimeError("No password given")
+        try:
+            info = Vault.peek(self.vault_file_name, password)
+        except Vault.BadPasswordError:
+            print("Bad password.")
+            raise
+        except Vault.VaultVersionError:
+            print("This is not a PasswordSafe V3 Vault.")
+            raise
+        except Vault.VaultFormatError:
+            print("Vault integrity check failed.")
+            raise
+        if info["last_save"] is not None:
+            last_save = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(info["last_save"]))
+        else:
+            last_save = None
+        print("Version    : %s" % info["version"])
+        print("Last saved : %s" % last_save)
+        print("Saved by   : %s" % info["what_saved"])
+        print("Iterations : %d" % info["iterations"])
+        print("File size  : %d" % info["file_size"])
+        print("Records    : ~%d (estimated from the first records)" % info["estimated_records"])
+
     def open_vault(self):
         print("Opening " + self.vault_file_name + "...", file=sys.stderr)
         try:
@@ -107,7 +140,7 @@ class InteractiveConsole(cmd.Cmd):
             return
 
         print("\nCommands:")
-        print("  ".join(("ls", "show", "quit", "add", "save", "import")))
+        print("  ".join(("ls", "show", "quit", "add", "save", "import", "merge")))
         print()
 
     def do_quit(self, line):
@@ -200,6 +233,49 @@ class InteractiveConsole(cmd.Cmd):
         except csv.Error as e:
             sys.exit('file %s, line %d: %s' % (line, data.line_num, e))
 
+    def do_merge(self, line):
+        """
+        Merges the records of another vault into this one: new records are added,
+        records that are newer in the other vault replace their counterparts.
+
+        Example: merge /home/user/other.psafe3
+        """
+
+        line = self._encode_line(line)
+
+        if not line:
+            cmd.Cmd.do_help(self, "merge")
+            return
+
+        password = self._getpass("Password of " + os.path.basename(line) + ": ")
+        try:
+            merge_vault = Vault(password, filename=line)
+        except Vault.BadPasswordError:
+            print("Bad password.")
+            return
+        except Vault.VaultVersionError:
+            print("This is not a PasswordSafe V3 Vault.")
+            return
+        except Vault.VaultFormatError:
+            print("Vault integrity check failed.")
+            return
+
+        plan = self.vault.plan_merge(merge_vault)
+        for (action, my_record, record) in plan:
+            if action == "new":
+                print("new      : " + record.title)
+            elif action == "update":
+                print("update   : " + my_record.title)
+            else:
+                print("conflict : " + my_record.title + " (newer in this vault, not merged)")
+        plan = [(action, my_record, record) for (action, my_record, record) in plan if action != "conflict"]
+        if plan:
+            self.vault.apply_merge(plan)
+            self.vault_modified = True
+            print("Merge completed, but not saved.")
+        else:
+            print("Nothing to merge.")
+
     def do_ls(self, line):
         """
         Show contents of this Vault. If an argument is added a case insensitive
@@ -214,8 +290,8 @@ class InteractiveConsole(cmd.Cmd):
         if line is not None:
             vault_records = self.find_titles(line)
         else:
-            vault_records = self.vault.records[:]
-            vault_records.sort(key=lambda e: six.text_type.lower(e))
+            columns = self.vault.columns()
+            vault_records = columns.rows(columns.sort(range(len(columns)), "title"))
 
         if vault_records is None:
             print("No matches found.")
@@ -276,32 +352,32 @@ Username : %s""" % (record.group,
         text = self._encode_line(text)
         line = self._encode_line(line)
 
+        titles = self.vault.columns().column("title")
         if len(text) < 1:
-            completions = [record.title for record in self.vault.records]
+            completions = list(titles)
         else:
             fulltext = line[5:]
             lastspace = fulltext.rfind(' ')
             if lastspace == -1:
-                completions = [record.title for record in self.vault.records if record.title.upper().startswith(text.upper())]
+                completions = [title for title in titles if title.upper().startswith(text.upper())]
             else:
-                completions = [record.title[lastspace+1:] for record in self.vault.records if record.title.upper().startswith(fulltext.upper())]
+                completions = [title[lastspace+1:] for title in titles if title.upper().startswith(fulltext.upper())]
 
         completions.sort(key=lambda e: six.text_type.lower(e))
         return completions
 
     def find_titles(self, regexp):
         "Finds titles, username, group, or combination of all 3 matching a regular expression. (Case insensitive)"
-        matches = []
         pat = re.compile(regexp, re.IGNORECASE)
-        for record in self.vault.records:
-            if pat.match(record.title) is not None:
-                matches.append(record)
-            elif pat.match(record.user) is not None:
-                matches.append(record)
-            elif pat.match(record.group) is not None:
-                matches.append(record)
-            elif pat.match(record.group+"."+record.title+" ["+record.user+"]") is not None:
-                matches.append(record)
+        columns = self.vault.columns()
+        rows = columns.match(pat, ["title", "user", "group"])
+        matched = set(rows)
+        (titles, users, groups) = (columns.column("title"), columns.column("user"), columns.column("group"))
+        for row in range(len(columns)):
+            if row not in matched and pat.match(groups[row]+"."+titles[row]+" ["+users[row]+"]") is not None:
+                rows.append(row)
+        rows.sort()
+        matches = columns.rows(rows)
 
         if len(matches) == 0:
             return None
@@ -317,6 +393,7 @@ def main(argv):
     parser.add_option("-s", "--show", dest="do_show", default=None, action="store", type="string", help="show entries matching REGEX", metavar="REGEX")
     parser.add_option("-i", "--interactive", dest="interactive", default=False, action="store_true", help="use command line interface")
     parser.add_option("-p", "--password", dest="passwd", default=False, action="store_true", help="Auto adds password to clipboard. (GTK Only)")
+    parser.add_option("--info", dest="do_info", default=False, action="store_true", help="show vault metadata without decrypting its records")
     parser.add_option("-e", "--echo", dest="echo", default=False, action="store_true", help="Causes password to be displayed on the screen")
     (options, args) = parser.parse_args()
 
@@ -335,6 +412,10 @@ def main(argv):
     else:
         interactiveConsole.vault_file_name = args[0]
 
+    if options.do_info:
+        interactiveConsole.show_info()
+        sys.exit(0)
+
     interactiveConsole.open_vault()
     if options.do_ls:
         interactiveConsole.do_ls("")
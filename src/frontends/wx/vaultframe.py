@@ -20,7 +20,6 @@
 import os
 import wx
 import wx.adv
-import six
 
 from .wxlocale import _
 from ...vault import Vault
@@ -50,7 +49,7 @@ class VaultFrame(wx.Frame):
             self.SetColumnWidth(0, 256)
             self.SetColumnWidth(1, 128)
             self.SetColumnWidth(2, 256)
-            self.sort_function = lambda e: six.text_type.lower(e.group)
+            self.sort_column = "group"
             self.update_fields()
 
         def OnGetItemText(self, item, col):
@@ -80,32 +79,14 @@ class VaultFrame(wx.Frame):
             if not self.vault:
                 self.displayed_entries = []
                 return
-            self.displayed_entries = [record for record in self.vault.records if self.filter_record(record)]
-
-            self.displayed_entries.sort(key=self.sort_function)
+            columns = self.vault.columns()
+            rows = columns.search(self._filterstring, ["title", "group", "user"] + (["notes"] if config.search_notes else []))
+            if config.search_passwd:
+                rows = sorted(set(rows).union(columns.search(self._filterstring, ["passwd"], ignore_case=False)))
+            self.displayed_entries = columns.rows(columns.sort(rows, self.sort_column))
             self.SetItemCount(len(self.displayed_entries))
             wx.ListCtrl.Refresh(self)
 
-        def filter_record(self,record):
-            if record.title.lower().find(self._filterstring.lower()) >= 0:
-               return True
-
-            if record.group.lower().find(self._filterstring.lower()) >= 0:
-               return True
-
-            if record.user.lower().find(self._filterstring.lower()) >= 0:
-               return True
-
-            if config.search_notes:
-             if record.notes.lower().find(self._filterstring.lower()) >= 0:
-                return True
-
-            if config.search_passwd:
-             if record.passwd.find(self._filterstring) >= 0:
-                return True
-
-            return False
-
         def set_vault(self, vault):
             """
             Set the Vault this control should display.
@@ -229,6 +210,8 @@ class VaultFrame(wx.Frame):
         self.vault_password = None
         self.vault = None
         self._is_modified = False
+        # set when the file was last saved without updating its header; see close_vault()
+        self._needs_full_save = False
 
     def _on_list_box_char(self, key_event):
         """
@@ -248,31 +231,55 @@ class VaultFrame(wx.Frame):
     def mark_modified(self):
         self._is_modified = True
         if ((self.vault_file_name is not None) and (self.vault_password is not None)):
-            self.save_vault(self.vault_file_name, self.vault_password)
+            self.save_vault(self.vault_file_name, self.vault_password, journal=True)
         self.list.update_fields()
 
     def open_vault(self, filename, password):
         """
         Set the Vault that this frame should display.
         """
+        self.close_vault()
         self.vault_file_name = None
         self.vault_password = None
         self._is_modified = False
+        self._needs_full_save = False
         self.vault = Vault(password, filename=filename)
         self.list.set_vault(self.vault)
         self.vault_file_name = filename
         self.vault_password = password
         self.statusbar.SetStatusText(_("Read Vault contents from disk"), 0)
 
-    def save_vault(self, filename, password):
+    def close_vault(self):
+        """
+        Fold the edit journal of the displayed Vault back into its file, and forget its keys.
+
+        The file is saved in full if anything was saved since it was opened,
+        so that the header's last save time is current.
+        """
+        if self.vault is None:
+            return
+        if (self.vault_file_name is not None) and (self.vault_password is not None) and (self._needs_full_save or os.path.exists(Vault.journal_filename(self.vault_file_name))):
+            self.save_vault(self.vault_file_name, self.vault_password)
+        self.vault.wipe_keys()
+
+    def save_vault(self, filename, password, journal=False):
         """
         Write Vault contents to disk.
+
+        With journal=True, only the changes are appended to the Vault's edit
+        journal (or the unchanged part of the file is reused), which leaves the
+        header's last save time as it was until the next full save.
         """
         try:
             self._is_modified = False
             self.vault_file_name = filename
             self.vault_password = password
-            self.vault.write_to_file(filename, password)
+            if journal:
+                self.vault.write_journal(filename, password)
+                self._needs_full_save = True
+            else:
+                self.vault.write_to_file(filename, password)
+                self._needs_full_save = False
             self.statusbar.SetStatusText(_("Wrote Vault contents to disk"), 0)
         except RuntimeError:
             dial = wx.MessageDialog(self,
@@ -324,11 +331,11 @@ class VaultFrame(wx.Frame):
         """
         col = event.GetColumn()
         if (col == 0):
-            self.list.sort_function = lambda e: six.text_type.lower(e.title)
+            self.list.sort_column = "title"
         if (col == 1):
-            self.list.sort_function = lambda e: six.text_type.lower(e.user)
+            self.list.sort_column = "user"
         if (col == 2):
-            self.list.sort_function = lambda e: six.text_type.lower(e.group)
+            self.list.sort_column = "group"
         self.list.update_fields()
 
     def _on_list_contextmenu(self, dummy):
@@ -465,23 +472,11 @@ if not, write to the Free Software Foundation, Inc.,
             return
 
         oldrecord_newrecord_reason_pairs = []  # list of (oldrecord, newrecord, reason) tuples to merge
-        for record in merge_vault.records:
-            # check if corresponding record exists in current Vault
-            my_record = None
-            for record2 in self.vault.records:
-                if record2.is_corresponding(record):
-                    my_record = record2
-                    break
-
-            # record is new
-            if not my_record:
+        for (action, my_record, record) in self.vault.plan_merge(merge_vault):
+            if action == "new":
                 oldrecord_newrecord_reason_pairs.append((None, record, _("new")))
-                continue
-
-            # record is more recent
-            if record.is_newer_than(my_record):
+            elif action == "update":
                 oldrecord_newrecord_reason_pairs.append((my_record, record, _('updates "%s"') % my_record.title))
-                continue
 
         dial = MergeFrame(self, oldrecord_newrecord_reason_pairs)
         retval = dial.ShowModal()
@@ -619,6 +614,7 @@ if not, write to the Free Software Foundation, Inc.,
         """
         Event handler: Fires when user closes the frame
         """
+        self.close_vault()
         self.Destroy()
 
     def _on_searchbox_char(self, evt):
@@ -0,0 +1,291 @@
+#
+# Loxodo -- Password Safe V3 compatible Password Vault
+# Copyright (C) 2008 Christoph Sommer <mail@christoph-sommer.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+"""
+Registry of Twofish block cipher implementations.
+
+Every backend is a class that takes the key as its only constructor argument
+and provides encrypt(data), decrypt(data), encrypt_into(src, dst),
+decrypt_into(src, dst), cbc_encrypt_into(src, dst, iv) and
+cbc_decrypt_into(src, dst, iv) for data that is a multiple of 16 bytes long,
+just like twofish.Twofish. CBC chaining state is passed in and returned as a
+tuple of four little-endian 32-bit words. The fastest backend that can be imported and passes the
+known-answer tests is used, unless the LOXODO_CIPHER_BACKEND environment
+variable names a specific one. The pure Python implementation is always
+available as a fallback.
+"""
+
+import binascii
+import importlib
+import os
+import struct
+
+from . import twofish
+
+ENV_VARIABLE = "LOXODO_CIPHER_BACKEND"
+
+# (key, plaintext, ciphertext) from the Twofish paper, plus the vector of twofish.py
+KNOWN_ANSWER_TESTS = [tuple(binascii.unhexlify(x) for x in vector) for vector in (
+    ("00000000000000000000000000000000",
+     "00000000000000000000000000000000",
+     "9f589f5cf6122c32b6bfec2f2ae8c35a"),
+    ("0123456789abcdeffedcba98765432100011223344556677",
+     "00000000000000000000000000000000",
+     "cfd1d2e5a9be9cdf501f13b892bd2248"),
+    ("0123456789abcdeffedcba987654321000112233445566778899aabbccddeeff",
+     "00000000000000000000000000000000",
+     "37527be0052334b89f0cfccae87cfa20"),
+    ("d43bb7556ea32e46f2a282b7d45b4e0d57ff739d4dc92c1bd7fc01700cc8216f",
+     "90afe91bb288544f2c32dc239b2635e6",
+     "6cb4561c40bf0a9705931cb6d408e7fa"),
+)]
+
+# Iterated tests of ECB_TBL.TXT from the Twofish submission: starting from an all-zero
+# key and plaintext, each ciphertext becomes the next plaintext and each plaintext is
+# prepended to the next key. Key length -> (ciphertexts of the first and the 49th step).
+TABLE_TESTS = dict((key_len, tuple(binascii.unhexlify(x) for x in vectors)) for (key_len, vectors) in (
+    (16, ("9f589f5cf6122c32b6bfec2f2ae8c35a", "5d9d4eeffa9151575524f115815a12e0")),
+    (24, ("efa71f788965bd4453f860178fc19101", "e75449212beef9f4a390bd860a640941")),
+    (32, ("57ff739d4dc92c1bd7fc01700cc8216f", "37fe26ff1cf66175f5ddf4c33b97a205")),
+))
+
+_block = struct.Struct("<4L")
+
+
+class BlockwiseCipher(object):
+    """
+    Adapts a cipher object that handles one 16-byte block per call to the bulk interface.
+    """
+    def __init__(self, cipher):
+        self.cipher = cipher
+
+    def encrypt(self, block):
+        ciphertext = bytearray(len(block))
+        self.encrypt_into(block, ciphertext)
+        return bytes(ciphertext)
+
+    def decrypt(self, block):
+        plaintext = bytearray(len(block))
+        self.decrypt_into(block, plaintext)
+        return bytes(plaintext)
+
+    def encrypt_into(self, src, dst):
+        self._process_into(self.cipher.encrypt, src, dst)
+
+    def decrypt_into(self, src, dst):
+        self._process_into(self.cipher.decrypt, src, dst)
+
+    def cbc_encrypt_into(self, src, dst, iv):
+        self._check_buffers(src, dst)
+        encrypt_block = self.cipher.encrypt
+        (v0, v1, v2, v3) = iv
+        for offset in range(0, len(src), 16):
+            (a, b, c, d) = _block.unpack_from(src, offset)
+            block = encrypt_block(_block.pack(a ^ v0, b ^ v1, c ^ v2, d ^ v3))
+            (v0, v1, v2, v3) = _block.unpack(block)
+            _block.pack_into(dst, offset, v0, v1, v2, v3)
+        return (v0, v1, v2, v3)
+
+    def cbc_decrypt_into(self, src, dst, iv):
+        self._check_buffers(src, dst)
+        src = memoryview(src)
+        decrypt_block = self.cipher.decrypt
+        (v0, v1, v2, v3) = iv
+        for offset in range(0, len(src), 16):
+            block = src[offset:offset + 16].tobytes()
+            (a, b, c, d) = _block.unpack(decrypt_block(block))
+            _block.pack_into(dst, offset, a ^ v0, b ^ v1, c ^ v2, d ^ v3)
+            (v0, v1, v2, v3) = _block.unpack(block)
+        return (v0, v1, v2, v3)
+
+    @staticmethod
+    def _check_buffers(src, dst):
+        if len(src) % 16:
+            raise ValueError("block size must be a multiple of 16")
+        if len(dst) < len(src):
+            raise ValueError("output buffer too small")
+
+    def _process_into(self, process_block, src, dst):
+        self._check_buffers(src, dst)
+        src = memoryview(src)
+        dst = memoryview(dst)
+        for offset in range(0, len(src), 16):
+            dst[offset:offset + 16] = process_block(src[offset:offset + 16].tobytes())
+
+
+class NativeTwofish(BlockwiseCipher):
+    """
+    Twofish from the "twofish" package (python-twofish), a binding to a C implementation.
+    """
+    def __init__(self, key):
+        BlockwiseCipher.__init__(self, importlib.import_module("twofish").Twofish(key))
+
+
+def _load_native_twofish():
+    if not hasattr(importlib.import_module("twofish"), "Twofish"):
+        raise ImportError("twofish package does not provide a Twofish class")
+    return NativeTwofish
+
+
+def _load_python():
+    return twofish.Twofish
+
+
+def _load_numpy():
+    from . import twofish_numpy
+    if not twofish_numpy.available():
+        raise ImportError("NumPy is not available")
+    return twofish_numpy.TwofishNumPy
+
+
+# name -> (priority, loader); a loader returns the backend class or raises ImportError
+_registry = {}
+
+# name -> backend class, or None if the backend is unusable on this system
+_probed = {}
+
+
+def register_backend(name, loader, priority=0):
+    """
+    Make a backend known. Backends with higher priority are preferred.
+    """
+    _registry[name] = (priority, loader)
+    _probed.pop(name, None)
+
+
+def _probe(name):
+    if name not in _probed:
+        try:
+            backend = _registry[name][1]()
+        except (ImportError, AttributeError, OSError):
+            backend = None
+        if backend is not None and not _passes_known_answer_tests(backend):
+            backend = None
+        _probed[name] = backend
+    return _probed[name]
+
+
+def _passes_known_answer_tests(backend):
+    try:
+        for (key, plaintext, ciphertext) in KNOWN_ANSWER_TESTS:
+            cipher = backend(key)
+            if cipher.encrypt(plaintext * 3) != ciphertext * 3:
+                return False
+            if cipher.decrypt(ciphertext * 3) != plaintext * 3:
+                return False
+    except Exception:
+        return False
+    return True
+
+
+def passes_table_tests(backend):
+    """
+    Return True if the given backend class computes all 49 steps of each ECB_TBL.TXT table correctly.
+    """
+    for (key_len, (first, last)) in TABLE_TESTS.items():
+        key = b"\x00" * key_len
+        plaintext = b"\x00" * 16
+        for step in range(49):
+            cipher = backend(key)
+            ciphertext = cipher.encrypt(plaintext)
+            if (step == 0 and ciphertext != first) or cipher.decrypt(ciphertext) != plaintext:
+                return False
+            key = (plaintext + key)[:key_len]
+            plaintext = ciphertext
+        if ciphertext != last:
+            return False
+    return True
+
+
+def available_backends():
+    """
+    Return the names of all usable backends, fastest first.
+    """
+    names = sorted(_registry, key=lambda name: -_registry[name][0])
+    return [name for name in names if _probe(name) is not None]
+
+
+def auto_selected(name=None):
+    """
+    Return True if neither the given name nor $LOXODO_CIPHER_BACKEND names a backend, so that the fastest one is used.
+    """
+    return name is None and not os.environ.get(ENV_VARIABLE)
+
+
+def fastest_backend():
+    """
+    Return the name of the fastest usable backend.
+    """
+    # only probe backends until the first usable one, so that the others are not imported
+    for name in sorted(_registry, key=lambda name: -_registry[name][0]):
+        if _probe(name) is not None:
+            return name
+
+
+def get_backend(name=None):
+    """
+    Return the backend class of the given name, of the one named in $LOXODO_CIPHER_BACKEND, or the fastest one.
+    """
+    if name is None:
+        name = os.environ.get(ENV_VARIABLE) or fastest_backend()
+    if name not in _registry:
+        raise RuntimeError("Unknown Twofish backend: %s" % name)
+    backend = _probe(name)
+    if backend is None:
+        raise RuntimeError("Twofish backend not available: %s" % name)
+    return backend
+
+
+def new_cipher(key, backend=None):
+    """
+    Return a Twofish block cipher for the given key, using the given or the default backend.
+    """
+    return get_backend(backend)(key)
+
+
+register_backend("python", _load_python, priority=0)
+register_backend("twofish", _load_native_twofish, priority=100)
+# only fast on many blocks at once, so never picked automatically; see twofish_numpy.THRESHOLD
+register_backend("numpy", _load_numpy, priority=-100)
+
+
+def test_backends(names=None):
+    """
+    Check the given backends (default: the one used unless another one is named) against the known answers.
+    """
+    if names is None:
+        names = [fastest_backend()]
+    for name in names:
+        for (key, plaintext, ciphertext) in KNOWN_ANSWER_TESTS:
+            cipher = new_cipher(key, name)
+            assert cipher.encrypt(plaintext) == ciphertext, name
+            assert cipher.decrypt(ciphertext) == plaintext, name
+            buf = bytearray(plaintext * 2)
+            cipher.encrypt_into(memoryview(buf), buf)
+            assert bytes(buf) == ciphertext * 2, name
+            cipher.decrypt_into(buf, buf)
+            assert bytes(buf) == plaintext * 2, name
+            # with a zero IV, the first CBC block is the ECB block
+            iv = cipher.cbc_encrypt_into(plaintext, buf, (0, 0, 0, 0))
+            assert bytes(buf[:16]) == ciphertext and iv == _block.unpack(ciphertext), name
+            assert cipher.cbc_decrypt_into(buf[:16], buf, (0, 0, 0, 0)) == iv, name
+            assert bytes(buf[:16]) == plaintext, name
+
+
+test_backends()
@@ -0,0 +1,191 @@
+#
+# Loxodo -- Password Safe V3 compatible Password Vault
+# Copyright (C) 2008 Christoph Sommer <mail@christoph-sommer.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+"""
+Correctness and speed checks for all Twofish implementations.
+
+Every implementation (each usable backend, plus the generic, specialized and
+wide-table variants of the pure Python code) first has to pass the known-answer
+tests: the vectors of the Twofish paper and the full iterated ECB_TBL.TXT
+tables. Then set_key latency, raw block throughput and ECB/CBC throughput at
+several input sizes are measured. Results are printed as JSON.
+
+Usage:
+    python -m src.twofish.bench [--sizes 1K,64K,1M,64M] [--output FILE]
+"""
+
+import json
+import os
+import platform
+import sys
+import timeit
+from optparse import OptionParser
+
+from . import backend
+from . import twofish
+from .twofish_cbc import TwofishCBC
+from .twofish_ecb import TwofishECB
+
+DEFAULT_SIZES = "1K,16K,256K,1M"
+
+
+def implementations():
+    """
+    Return (name, class or factory taking a key) of every Twofish implementation to check.
+    """
+    result = [
+        ("python", lambda key: twofish.Twofish(key, specialize=False, wide_tables=False)),
+        ("python-specialized", lambda key: twofish.Twofish(key, specialize=True, wide_tables=False)),
+        ("python-wide", lambda key: twofish.Twofish(key, wide_tables=True)),
+    ]
+    for name in backend.available_backends():
+        if name != "python":
+            result.append((name, backend.get_backend(name)))
+    return result
+
+
+def parse_size(text):
+    """
+    Return the number of bytes given as e.g. "512", "16K" or "64M".
+    """
+    text = text.strip().upper()
+    for (suffix, factor) in (("K", 1024), ("M", 1024 * 1024)):
+        if text.endswith(suffix):
+            return int(text[:-1]) * factor
+    return int(text)
+
+
+def best_of(func, number, repeat=3):
+    """
+    Return the best-case duration of one call of func in seconds.
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def table_memory(tables):
+    """
+    Return the approximate number of bytes used by a sequence of lists of ints.
+    """
+    return sum(sys.getsizeof(table) + sum(sys.getsizeof(x) for x in table) for table in tables)
+
+
+def check_known_answers(factory):
+    """
+    Return the known-answer test results of one implementation.
+    """
+    paper = True
+    for (key, plaintext, ciphertext) in backend.KNOWN_ANSWER_TESTS:
+        cipher = factory(key)
+        if cipher.encrypt(plaintext) != ciphertext or cipher.decrypt(ciphertext) != plaintext:
+            paper = False
+    return {"paper": paper, "table": backend.passes_table_tests(factory)}
+
+
+def bench_set_key(factory, key_len=32):
+    """
+    Return the best-case latency of creating a cipher for a new key in seconds.
+    """
+    key = bytes(bytearray(range(key_len)))
+    seconds = best_of(lambda: factory(key), number=1)
+    return best_of(lambda: factory(key), number=max(1, min(200, int(0.2 / max(seconds, 1e-6)))))
+
+
+def bench_blocks(factory, size=65536):
+    """
+    Return the best-case (encrypt, decrypt) ECB throughput of raw block operations in bytes per second.
+    """
+    cipher = factory(bytes(bytearray(range(32))))
+    # random data, as all-zero blocks always hit the same table entries and hide cache misses
+    data = os.urandom(size)
+    buf = bytearray(size)
+    # warm up, so that lazily compiled round functions and tables are in place
+    cipher.encrypt_into(data, buf)
+    return (size / best_of(lambda: cipher.encrypt_into(data, buf), number=1),
+            size / best_of(lambda: cipher.decrypt_into(data, buf), number=1))
+
+
+def bench_modes(size, cipher_backend=None):
+    """
+    Return the throughput of ECB and CBC en-/decryption of size bytes in bytes per second.
+    """
+    key = bytes(bytearray(range(32)))
+    init_vec = bytes(bytearray(range(16)))
+    data = os.urandom(size)
+    repeat = 3 if size <= 1048576 else 1
+    operations = (
+        ("ecb-encrypt", lambda: TwofishECB(key, cipher_backend).encrypt(data)),
+        ("ecb-decrypt", lambda: TwofishECB(key, cipher_backend).decrypt(data)),
+        ("cbc-encrypt", lambda: TwofishCBC(key, init_vec, cipher_backend).encrypt(data)),
+        ("cbc-decrypt", lambda: TwofishCBC(key, init_vec, cipher_backend).decrypt(data)),
+    )
+    return dict((name, size / best_of(func, number=1, repeat=repeat)) for (name, func) in operations)
+
+
+def run(sizes):
+    """
+    Run all checks and benchmarks and return the results as a dict.
+    """
+    backend.test_backends(backend.available_backends())
+    context = twofish.Twofish(bytes(bytearray(range(32))), wide_tables=True).context
+    results = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "default_backend": backend.fastest_backend(),
+        "table_bytes": {"compact": table_memory(context.mk_tab), "wide": table_memory(context.wide_tab)},
+        "specialize_seconds": best_of(lambda: twofish.gen_kernels(context), number=5),
+        "known_answers": {},
+        "set_key_seconds": {},
+        "block_bytes_per_second": {},
+        "mode_bytes_per_second": {},
+    }
+    for (name, factory) in implementations():
+        results["known_answers"][name] = check_known_answers(factory)
+        results["set_key_seconds"][name] = bench_set_key(factory)
+        (encrypt, decrypt) = bench_blocks(factory)
+        results["block_bytes_per_second"][name] = {"encrypt": encrypt, "decrypt": decrypt}
+    for name in backend.available_backends():
+        results["mode_bytes_per_second"][name] = dict((str(size), bench_modes(size, name)) for size in sizes)
+    return results
+
+
+def main(argv):
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-s", "--sizes", dest="sizes", default=DEFAULT_SIZES, help="comma-separated input sizes for the ECB/CBC benchmarks, e.g. 1K,64K,64M [default: %default]")
+    parser.add_option("-o", "--output", dest="output", default=None, help="write JSON results to FILE instead of stdout", metavar="FILE")
+    (options, args) = parser.parse_args(argv)
+
+    sizes = [parse_size(size) for size in options.sizes.split(",")]
+    results = run(sizes)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as filehandle:
+            filehandle.write(text + "\n")
+    else:
+        print(text)
+
+    failed = [name for (name, kat) in results["known_answers"].items() if not all(kat.values())]
+    if failed:
+        sys.stderr.write("Known-answer tests failed for: " + ", ".join(sorted(failed)) + "\n")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
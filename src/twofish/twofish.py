@@ -40,10 +40,29 @@ block_size = 16
 key_size = 32
 
 class Twofish:
-    
-    def __init__(self, key=None):
-        """Twofish."""
 
+    # bytes to process with the generic round functions before compiling ones specialized for the key
+    SPECIALIZE_AFTER = 65536
+
+    # bytes to process with compact tables before switching to wide ones (if WIDE_TABLES is set)
+    WIDE_TABLES_AFTER = 1048576
+    
+    def __init__(self, key=None, specialize=None, wide_tables=None):
+        """Twofish.
+
+        specialize: True to compile round functions specialized for the key
+        right away, False to never do so, None to do so once more than
+        SPECIALIZE_AFTER bytes were processed with the key.
+
+        wide_tables: True to use round functions with 16-bit indexed tables
+        (see gen_wide_tab) right away, False to never do so, None to do so
+        once more than WIDE_TABLES_AFTER bytes were processed with the key if
+        the module-level WIDE_TABLES is set (it is not by default) and
+        specialize is not False. Wide tables imply specialized round functions.
+        """
+
+        self.specialize = specialize
+        self.wide_tables = wide_tables
         if key:
             self.set_key(key)
 
@@ -72,6 +91,12 @@ class Twofish:
             i += 1
 
         set_key(self.context, key_word32, key_len)
+        self.processed = 0
+        if self.wide_tables:
+            gen_wide_tab(self.context)
+            gen_kernels(self.context)
+        elif self.specialize:
+            gen_kernels(self.context)
 
         
     def decrypt(self, block):
@@ -80,16 +105,9 @@ class Twofish:
         if len(block) % 16:
             raise ValueError("block size must be a multiple of 16")
 
-        plaintext = b''
-        
-        while block:
-            a, b, c, d = struct.unpack("<4L", block[:16])
-            temp = [a, b, c, d]
-            decrypt(self.context, temp)
-            plaintext += struct.pack("<4L", *temp)
-            block = block[16:]
-            
-        return plaintext
+        plaintext = bytearray(len(block))
+        self.decrypt_into(block, plaintext)
+        return bytes(plaintext)
 
         
     def encrypt(self, block):
@@ -98,16 +116,66 @@ class Twofish:
         if len(block) % 16:
             raise ValueError("block size must be a multiple of 16")
 
-        ciphertext = b''
-        
-        while block:
-            a, b, c, d = struct.unpack("<4L", block[0:16])
-            temp = [a, b, c, d]
-            encrypt(self.context, temp)
-            ciphertext += struct.pack("<4L", *temp)
-            block = block[16:]
-            
-        return ciphertext
+        ciphertext = bytearray(len(block))
+        self.encrypt_into(block, ciphertext)
+        return bytes(ciphertext)
+
+
+    def decrypt_into(self, src, dst):
+        """Decrypt all blocks of buffer src into the writable buffer dst (which may be src)."""
+
+        if self._specialized(len(src)):
+            self.context.decrypt_into(src, dst)
+        else:
+            decrypt_into(self.context, src, dst)
+
+
+    def encrypt_into(self, src, dst):
+        """Encrypt all blocks of buffer src into the writable buffer dst (which may be src)."""
+
+        if self._specialized(len(src)):
+            self.context.encrypt_into(src, dst)
+        else:
+            encrypt_into(self.context, src, dst)
+
+
+    def cbc_decrypt_into(self, src, dst, iv):
+        """Decrypt buffer src in CBC mode into the writable buffer dst (which may be src).
+
+        iv is the chaining state as a tuple of four little-endian 32-bit words;
+        returns the chaining state to continue with.
+        """
+
+        if self._specialized(len(src)):
+            return self.context.cbc_decrypt_into(src, dst, iv)
+        return cbc_decrypt_into(self.context, src, dst, iv)
+
+
+    def cbc_encrypt_into(self, src, dst, iv):
+        """Encrypt buffer src in CBC mode into the writable buffer dst (which may be src).
+
+        iv is the chaining state as a tuple of four little-endian 32-bit words;
+        returns the chaining state to continue with.
+        """
+
+        if self._specialized(len(src)):
+            return self.context.cbc_encrypt_into(src, dst, iv)
+        return cbc_encrypt_into(self.context, src, dst, iv)
+
+
+    def _specialized(self, length):
+        """Return True if specialized round functions are (now) available for the key."""
+
+        context = self.context
+        self.processed += length
+        if (self.wide_tables is None and WIDE_TABLES and self.specialize is not False
+                and context.wide_tab is None and self.processed > self.WIDE_TABLES_AFTER):
+            gen_wide_tab(context)
+            gen_kernels(context)
+        elif (self.specialize is None and context.encrypt_into is None
+                and self.processed > self.SPECIALIZE_AFTER):
+            gen_kernels(context)
+        return context.encrypt_into is not None
 
 
     def get_name(self):
@@ -132,8 +200,14 @@ class Twofish:
 # Private.
 #
 
+import os
 import struct
 import sys
+from array import array
+
+# set LOXODO_TWOFISH_TABLES=wide to switch to the ~10 MB of wide tables per key automatically;
+# they are no faster than the compact ones on random data on most machines
+WIDE_TABLES = os.environ.get("LOXODO_TWOFISH_TABLES", "compact") == "wide"
 
 WORD_BIGENDIAN = 0
 if sys.byteorder == 'big':
@@ -154,11 +228,16 @@ class TWI:
         self.k_len = 0 # word32
         self.l_key = [0]*40 # word32
         self.s_key = [0]*4 # word32
-        self.qt_gen = 0 # word32
-        self.q_tab = [[0]*256, [0]*256] # byte
-        self.mt_gen = 0 # word32
-        self.m_tab = [[0]*256, [0]*256, [0]*256, [0]*256] # word32
+        self.qt_gen = 1 # word32
+        self.q_tab = Q_TAB # byte, shared by all keys
+        self.mt_gen = 1 # word32
+        self.m_tab = M_TAB # word32, shared by all keys
         self.mk_tab = [[0]*256, [0]*256, [0]*256, [0]*256] # word32
+        self.wide_tab = None # word32, see gen_wide_tab
+        self.encrypt_into = None # specialized round functions, see gen_kernels
+        self.decrypt_into = None
+        self.cbc_encrypt_into = None
+        self.cbc_decrypt_into = None
 
 def byte(x, n):
     return (x >> (8 * n)) & 0xff
@@ -191,48 +270,57 @@ def qp(n, x): # word32, byte
     b4 = qt3[n][b3];
     return (b4 << 4) | a4;
 
-def gen_qtab(pkey):
-    for i in range(256):
-        pkey.q_tab[0][i] = qp(0, i)
-        pkey.q_tab[1][i] = qp(1, i)
-        
-def gen_mtab(pkey):
+def gen_qtab():
+    """Return the key-independent q permutation tables."""
+    return (array('L', [qp(0, i) for i in range(256)]),
+            array('L', [qp(1, i) for i in range(256)]))
+
+def gen_mtab(q_tab):
+    """Return the key-independent MDS multiplication tables."""
+    m_tab = (array('L', [0]*256), array('L', [0]*256), array('L', [0]*256), array('L', [0]*256))
     for i in range(256):
-        f01 = pkey.q_tab[1][i]
-        f01 = pkey.q_tab[1][i];
+        f01 = q_tab[1][i];
         f5b = ((f01) ^ ((f01) >> 2) ^ tab_5b[(f01) & 3]);
         fef = ((f01) ^ ((f01) >> 1) ^ ((f01) >> 2) ^ tab_ef[(f01) & 3]);
-        pkey.m_tab[0][i] = f01 + (f5b << 8) + (fef << 16) + (fef << 24);
-        pkey.m_tab[2][i] = f5b + (fef << 8) + (f01 << 16) + (fef << 24);
+        m_tab[0][i] = f01 + (f5b << 8) + (fef << 16) + (fef << 24);
+        m_tab[2][i] = f5b + (fef << 8) + (f01 << 16) + (fef << 24);
 
-        f01 = pkey.q_tab[0][i];
+        f01 = q_tab[0][i];
         f5b = ((f01) ^ ((f01) >> 2) ^ tab_5b[(f01) & 3]);
         fef = ((f01) ^ ((f01) >> 1) ^ ((f01) >> 2) ^ tab_ef[(f01) & 3]);
-        pkey.m_tab[1][i] = fef + (fef << 8) + (f5b << 16) + (f01 << 24);
-        pkey.m_tab[3][i] = f5b + (f01 << 8) + (fef << 16) + (f5b << 24);
+        m_tab[1][i] = fef + (fef << 8) + (f5b << 16) + (f01 << 24);
+        m_tab[3][i] = f5b + (f01 << 8) + (fef << 16) + (f5b << 24);
+    return m_tab
+
+# q and m tables do not depend on the key: compute them once per process
+Q_TAB = gen_qtab()
+M_TAB = gen_mtab(Q_TAB)
+
+# q permutation applied before xoring in each key word, for bytes 0..3 of the input
+MK_Q_SEL = ((0, 0, 1, 1), (0, 1, 0, 1), (1, 1, 0, 0), (1, 0, 0, 1))
 
 def gen_mk_tab(pkey, key):
-    if pkey.k_len == 2:
-        for i in range(256):
-            by = i % 0x100
-            pkey.mk_tab[0][i] = pkey.m_tab[0][pkey.q_tab[0][pkey.q_tab[0][by] ^ byte(key[1],0)] ^ byte(key[0],0)];
-            pkey.mk_tab[1][i] = pkey.m_tab[1][pkey.q_tab[0][pkey.q_tab[1][by] ^ byte(key[1],1)] ^ byte(key[0],1)];
-            pkey.mk_tab[2][i] = pkey.m_tab[2][pkey.q_tab[1][pkey.q_tab[0][by] ^ byte(key[1],2)] ^ byte(key[0],2)];
-            pkey.mk_tab[3][i] = pkey.m_tab[3][pkey.q_tab[1][pkey.q_tab[1][by] ^ byte(key[1],3)] ^ byte(key[0],3)];
-    if pkey.k_len == 3:
-        for i in range(256):
-            by = i % 0x100
-            pkey.mk_tab[0][i] = pkey.m_tab[0][pkey.q_tab[0][pkey.q_tab[0][pkey.q_tab[1][by] ^ byte(key[2], 0)] ^ byte(key[1], 0)] ^ byte(key[0], 0)];
-            pkey.mk_tab[1][i] = pkey.m_tab[1][pkey.q_tab[0][pkey.q_tab[1][pkey.q_tab[1][by] ^ byte(key[2], 1)] ^ byte(key[1], 1)] ^ byte(key[0], 1)];
-            pkey.mk_tab[2][i] = pkey.m_tab[2][pkey.q_tab[1][pkey.q_tab[0][pkey.q_tab[0][by] ^ byte(key[2], 2)] ^ byte(key[1], 2)] ^ byte(key[0], 2)];
-            pkey.mk_tab[3][i] = pkey.m_tab[3][pkey.q_tab[1][pkey.q_tab[1][pkey.q_tab[0][by] ^ byte(key[2], 3)] ^ byte(key[1], 3)] ^ byte(key[0], 3)];
-    if pkey.k_len == 4:
-        for i in range(256):
-            by = i % 0x100
-            pkey.mk_tab[0][i] = pkey.m_tab[0][pkey.q_tab[0][pkey.q_tab[0][pkey.q_tab[1][pkey.q_tab[1][by] ^ byte(key[3], 0)] ^ byte(key[2], 0)] ^ byte(key[1], 0)] ^ byte(key[0], 0)];
-            pkey.mk_tab[1][i] = pkey.m_tab[1][pkey.q_tab[0][pkey.q_tab[1][pkey.q_tab[1][pkey.q_tab[0][by] ^ byte(key[3], 1)] ^ byte(key[2], 1)] ^ byte(key[1], 1)] ^ byte(key[0], 1)];
-            pkey.mk_tab[2][i] = pkey.m_tab[2][pkey.q_tab[1][pkey.q_tab[0][pkey.q_tab[0][pkey.q_tab[0][by] ^ byte(key[3], 2)] ^ byte(key[2], 2)] ^ byte(key[1], 2)] ^ byte(key[0], 2)];
-            pkey.mk_tab[3][i] = pkey.m_tab[3][pkey.q_tab[1][pkey.q_tab[1][pkey.q_tab[0][pkey.q_tab[1][by] ^ byte(key[3], 3)] ^ byte(key[2], 3)] ^ byte(key[1], 3)] ^ byte(key[0], 3)];
+    q_tab = pkey.q_tab
+    for n in range(4):
+        col = range(256)
+        for k in range(pkey.k_len - 1, -1, -1):
+            q = q_tab[MK_Q_SEL[k][n]]
+            kb = byte(key[k], n)
+            col = [q[x] ^ kb for x in col]
+        m = pkey.m_tab[n]
+        pkey.mk_tab[n] = [m[x] for x in col]
+
+def gen_wide_tab(pkey):
+    """Combine pairs of mk_tab tables into 65536-entry tables indexed by 16 bits of the input.
+
+    g0(x) = w0lo[x & 0xffff] ^ w0hi[x >> 16] and g1(x) = w1lo[x & 0xffff] ^ w1hi[x >> 16],
+    which halves the lookups per round at the cost of about 10 MB per key.
+    """
+    m0, m1, m2, m3 = pkey.mk_tab
+    pkey.wide_tab = ([hi ^ lo for hi in m1 for lo in m0],
+                     [hi ^ lo for hi in m3 for lo in m2],
+                     [hi ^ lo for hi in m2 for lo in m1],
+                     [hi ^ lo for hi in m0 for lo in m3])
 
 def h_fun(pkey, x, key):
     b0 = byte(x, 0);
@@ -273,14 +361,6 @@ def mds_rem(p0, p1):
     return p1
 
 def set_key(pkey, in_key, key_len):
-    pkey.qt_gen = 0
-    if not pkey.qt_gen:
-        gen_qtab(pkey)
-        pkey.qt_gen = 1
-    pkey.mt_gen = 0
-    if not pkey.mt_gen:
-        gen_mtab(pkey)
-        pkey.mt_gen = 1
     pkey.k_len = (key_len * 8) // 64
 
     a = 0
@@ -386,8 +466,273 @@ def decrypt(pkey, in_blk):
         in_blk[3] = blk[1] ^ pkey.l_key[3];
     return
 
+def _check_buffers(src, dst):
+    if len(src) % 16:
+        raise ValueError("block size must be a multiple of 16")
+    if len(dst) < len(src):
+        raise ValueError("output buffer too small")
+
+_block = struct.Struct("<4L")
+
+def encrypt_into(pkey, src, dst):
+    _check_buffers(src, dst)
+    unpack_from = _block.unpack_from
+    pack_into = _block.pack_into
+    m0, m1, m2, m3 = pkey.mk_tab
+    k = pkey.l_key
+    k0, k1, k2, k3, k4, k5, k6, k7 = k[0:8]
+    rounds = range(8, 40, 4)
+
+    for off in range(0, len(src), 16):
+        a, b, c, d = unpack_from(src, off)
+        a ^= k0
+        b ^= k1
+        c ^= k2
+        d ^= k3
+
+        for i in rounds:
+            t1 = m0[b >> 24] ^ m1[b & 0xff] ^ m2[(b >> 8) & 0xff] ^ m3[(b >> 16) & 0xff]
+            t0 = m0[a & 0xff] ^ m1[(a >> 8) & 0xff] ^ m2[(a >> 16) & 0xff] ^ m3[a >> 24]
+            c ^= (t0 + t1 + k[i]) & 0xffffffff
+            c = (c >> 1) | ((c << 31) & 0xffffffff)
+            d = (((d << 1) & 0xffffffff) | (d >> 31)) ^ ((t0 + 2 * t1 + k[i + 1]) & 0xffffffff)
+
+            t1 = m0[d >> 24] ^ m1[d & 0xff] ^ m2[(d >> 8) & 0xff] ^ m3[(d >> 16) & 0xff]
+            t0 = m0[c & 0xff] ^ m1[(c >> 8) & 0xff] ^ m2[(c >> 16) & 0xff] ^ m3[c >> 24]
+            a ^= (t0 + t1 + k[i + 2]) & 0xffffffff
+            a = (a >> 1) | ((a << 31) & 0xffffffff)
+            b = (((b << 1) & 0xffffffff) | (b >> 31)) ^ ((t0 + 2 * t1 + k[i + 3]) & 0xffffffff)
+
+        pack_into(dst, off, c ^ k4, d ^ k5, a ^ k6, b ^ k7)
+
+def decrypt_into(pkey, src, dst):
+    _check_buffers(src, dst)
+    unpack_from = _block.unpack_from
+    pack_into = _block.pack_into
+    m0, m1, m2, m3 = pkey.mk_tab
+    k = pkey.l_key
+    k0, k1, k2, k3, k4, k5, k6, k7 = k[0:8]
+    rounds = range(36, 4, -4)
+
+    for off in range(0, len(src), 16):
+        a, b, c, d = unpack_from(src, off)
+        a ^= k4
+        b ^= k5
+        c ^= k6
+        d ^= k7
+
+        for i in rounds:
+            t1 = m0[b >> 24] ^ m1[b & 0xff] ^ m2[(b >> 8) & 0xff] ^ m3[(b >> 16) & 0xff]
+            t0 = m0[a & 0xff] ^ m1[(a >> 8) & 0xff] ^ m2[(a >> 16) & 0xff] ^ m3[a >> 24]
+            c = (((c << 1) & 0xffffffff) | (c >> 31)) ^ ((t0 + t1 + k[i + 2]) & 0xffffffff)
+            d ^= (t0 + 2 * t1 + k[i + 3]) & 0xffffffff
+            d = (d >> 1) | ((d << 31) & 0xffffffff)
+
+            t1 = m0[d >> 24] ^ m1[d & 0xff] ^ m2[(d >> 8) & 0xff] ^ m3[(d >> 16) & 0xff]
+            t0 = m0[c & 0xff] ^ m1[(c >> 8) & 0xff] ^ m2[(c >> 16) & 0xff] ^ m3[c >> 24]
+            a = (((a << 1) & 0xffffffff) | (a >> 31)) ^ ((t0 + t1 + k[i]) & 0xffffffff)
+            b ^= (t0 + 2 * t1 + k[i + 1]) & 0xffffffff
+            b = (b >> 1) | ((b << 31) & 0xffffffff)
+
+        pack_into(dst, off, c ^ k0, d ^ k1, a ^ k2, b ^ k3)
+
+def cbc_encrypt_into(pkey, src, dst, iv):
+    _check_buffers(src, dst)
+    unpack_from = _block.unpack_from
+    pack_into = _block.pack_into
+    m0, m1, m2, m3 = pkey.mk_tab
+    k = pkey.l_key
+    k0, k1, k2, k3, k4, k5, k6, k7 = k[0:8]
+    rounds = range(8, 40, 4)
+    v0, v1, v2, v3 = iv
+
+    for off in range(0, len(src), 16):
+        a, b, c, d = unpack_from(src, off)
+        a ^= v0 ^ k0
+        b ^= v1 ^ k1
+        c ^= v2 ^ k2
+        d ^= v3 ^ k3
+
+        for i in rounds:
+            t1 = m0[b >> 24] ^ m1[b & 0xff] ^ m2[(b >> 8) & 0xff] ^ m3[(b >> 16) & 0xff]
+            t0 = m0[a & 0xff] ^ m1[(a >> 8) & 0xff] ^ m2[(a >> 16) & 0xff] ^ m3[a >> 24]
+            c ^= (t0 + t1 + k[i]) & 0xffffffff
+            c = (c >> 1) | ((c << 31) & 0xffffffff)
+            d = (((d << 1) & 0xffffffff) | (d >> 31)) ^ ((t0 + 2 * t1 + k[i + 1]) & 0xffffffff)
+
+            t1 = m0[d >> 24] ^ m1[d & 0xff] ^ m2[(d >> 8) & 0xff] ^ m3[(d >> 16) & 0xff]
+            t0 = m0[c & 0xff] ^ m1[(c >> 8) & 0xff] ^ m2[(c >> 16) & 0xff] ^ m3[c >> 24]
+            a ^= (t0 + t1 + k[i + 2]) & 0xffffffff
+            a = (a >> 1) | ((a << 31) & 0xffffffff)
+            b = (((b << 1) & 0xffffffff) | (b >> 31)) ^ ((t0 + 2 * t1 + k[i + 3]) & 0xffffffff)
+
+        v0 = c ^ k4
+        v1 = d ^ k5
+        v2 = a ^ k6
+        v3 = b ^ k7
+        pack_into(dst, off, v0, v1, v2, v3)
+
+    return (v0, v1, v2, v3)
+
+def cbc_decrypt_into(pkey, src, dst, iv):
+    _check_buffers(src, dst)
+    unpack_from = _block.unpack_from
+    pack_into = _block.pack_into
+    m0, m1, m2, m3 = pkey.mk_tab
+    k = pkey.l_key
+    k0, k1, k2, k3, k4, k5, k6, k7 = k[0:8]
+    rounds = range(36, 4, -4)
+    v0, v1, v2, v3 = iv
+
+    for off in range(0, len(src), 16):
+        a, b, c, d = w = unpack_from(src, off)
+        a ^= k4
+        b ^= k5
+        c ^= k6
+        d ^= k7
+
+        for i in rounds:
+            t1 = m0[b >> 24] ^ m1[b & 0xff] ^ m2[(b >> 8) & 0xff] ^ m3[(b >> 16) & 0xff]
+            t0 = m0[a & 0xff] ^ m1[(a >> 8) & 0xff] ^ m2[(a >> 16) & 0xff] ^ m3[a >> 24]
+            c = (((c << 1) & 0xffffffff) | (c >> 31)) ^ ((t0 + t1 + k[i + 2]) & 0xffffffff)
+            d ^= (t0 + 2 * t1 + k[i + 3]) & 0xffffffff
+            d = (d >> 1) | ((d << 31) & 0xffffffff)
+
+            t1 = m0[d >> 24] ^ m1[d & 0xff] ^ m2[(d >> 8) & 0xff] ^ m3[(d >> 16) & 0xff]
+            t0 = m0[c & 0xff] ^ m1[(c >> 8) & 0xff] ^ m2[(c >> 16) & 0xff] ^ m3[c >> 24]
+            a = (((a << 1) & 0xffffffff) | (a >> 31)) ^ ((t0 + t1 + k[i]) & 0xffffffff)
+            b ^= (t0 + 2 * t1 + k[i + 1]) & 0xffffffff
+            b = (b >> 1) | ((b << 31) & 0xffffffff)
+
+        pack_into(dst, off, c ^ k0 ^ v0, d ^ k1 ^ v1, a ^ k2 ^ v2, b ^ k3 ^ v3)
+        v0, v1, v2, v3 = w
+
+    return (v0, v1, v2, v3)
+
+def _g0_src(x, wide):
+    if wide:
+        return "w0lo[%s & 0xffff] ^ w0hi[%s >> 16]" % (x, x)
+    return "m0[%s & 0xff] ^ m1[%s >> 8 & 0xff] ^ m2[%s >> 16 & 0xff] ^ m3[%s >> 24]" % (x, x, x, x)
+
+def _g1_src(x, wide):
+    if wide:
+        return "w1lo[%s & 0xffff] ^ w1hi[%s >> 16]" % (x, x)
+    return "m0[%s >> 24] ^ m1[%s & 0xff] ^ m2[%s >> 8 & 0xff] ^ m3[%s >> 16 & 0xff]" % (x, x, x, x)
+
+def _rotr1_src(x):
+    return "%s = %s >> 1 | (%s & 1) << 31" % (x, x, x)
+
+def _rotl1_src(x):
+    return "(%s << 1 & 0xffffffff | %s >> 31)" % (x, x)
+
+def _kernel_src(name, pkey, encrypt, cbc):
+    k = ["0x%08x" % x for x in pkey.l_key]
+    wide = pkey.wide_tab is not None
+    g0 = lambda x: _g0_src(x, wide)
+    g1 = lambda x: _g1_src(x, wide)
+    body = lambda lines: ["        " + line for line in lines]
+
+    src = [
+        "def %s(src, dst%s, check=_check_buffers, unpack_from=_block.unpack_from, pack_into=_block.pack_into," % (name, ", iv" if cbc else ""),
+        "        w0lo=w0lo, w0hi=w0hi, w1lo=w1lo, w1hi=w1hi):" if wide else "        m0=m0, m1=m1, m2=m2, m3=m3):",
+        "    check(src, dst)",
+    ]
+    if cbc:
+        src += ["    v0, v1, v2, v3 = iv"]
+    src += ["    for off in range(0, len(src), 16):"]
+
+    if encrypt:
+        src += body(["a, b, c, d = unpack_from(src, off)"])
+        if cbc:
+            src += body(["a ^= v0 ^ %s" % k[0], "b ^= v1 ^ %s" % k[1], "c ^= v2 ^ %s" % k[2], "d ^= v3 ^ %s" % k[3]])
+        else:
+            src += body(["a ^= %s" % k[0], "b ^= %s" % k[1], "c ^= %s" % k[2], "d ^= %s" % k[3]])
+        for i in range(8, 40, 4):
+            src += body([
+                "t1 = " + g1("b"),
+                "t0 = " + g0("a"),
+                "c ^= t0 + t1 + %s & 0xffffffff" % k[i],
+                _rotr1_src("c"),
+                "d = %s ^ (t0 + 2 * t1 + %s & 0xffffffff)" % (_rotl1_src("d"), k[i + 1]),
+                "t1 = " + g1("d"),
+                "t0 = " + g0("c"),
+                "a ^= t0 + t1 + %s & 0xffffffff" % k[i + 2],
+                _rotr1_src("a"),
+                "b = %s ^ (t0 + 2 * t1 + %s & 0xffffffff)" % (_rotl1_src("b"), k[i + 3]),
+            ])
+        if cbc:
+            src += body([
+                "v0 = c ^ %s" % k[4], "v1 = d ^ %s" % k[5], "v2 = a ^ %s" % k[6], "v3 = b ^ %s" % k[7],
+                "pack_into(dst, off, v0, v1, v2, v3)",
+            ])
+        else:
+            src += body(["pack_into(dst, off, c ^ %s, d ^ %s, a ^ %s, b ^ %s)" % (k[4], k[5], k[6], k[7])])
+    else:
+        if cbc:
+            src += body(["a, b, c, d = w = unpack_from(src, off)"])
+        else:
+            src += body(["a, b, c, d = unpack_from(src, off)"])
+        src += body(["a ^= %s" % k[4], "b ^= %s" % k[5], "c ^= %s" % k[6], "d ^= %s" % k[7]])
+        for i in range(36, 4, -4):
+            src += body([
+                "t1 = " + g1("b"),
+                "t0 = " + g0("a"),
+                "c = %s ^ (t0 + t1 + %s & 0xffffffff)" % (_rotl1_src("c"), k[i + 2]),
+                "d ^= t0 + 2 * t1 + %s & 0xffffffff" % k[i + 3],
+                _rotr1_src("d"),
+                "t1 = " + g1("d"),
+                "t0 = " + g0("c"),
+                "a = %s ^ (t0 + t1 + %s & 0xffffffff)" % (_rotl1_src("a"), k[i]),
+                "b ^= t0 + 2 * t1 + %s & 0xffffffff" % k[i + 1],
+                _rotr1_src("b"),
+            ])
+        if cbc:
+            src += body([
+                "pack_into(dst, off, c ^ v0 ^ %s, d ^ v1 ^ %s, a ^ v2 ^ %s, b ^ v3 ^ %s)" % (k[0], k[1], k[2], k[3]),
+                "v0, v1, v2, v3 = w",
+            ])
+        else:
+            src += body(["pack_into(dst, off, c ^ %s, d ^ %s, a ^ %s, b ^ %s)" % (k[0], k[1], k[2], k[3])])
+
+    if cbc:
+        src += ["    return (v0, v1, v2, v3)"]
+    return src
+
+def gen_kernels_src(pkey):
+    """Return Python source of the ECB and CBC round functions with all rounds unrolled and the subkeys of pkey inlined."""
+
+    src = []
+    for (name, encrypt, cbc) in KERNELS:
+        src += _kernel_src(name, pkey, encrypt, cbc) + [""]
+    return "\n".join(src)
+
+# name, encrypt?, CBC mode? of the round functions compiled by gen_kernels
+KERNELS = (
+    ("encrypt_into", True, False),
+    ("decrypt_into", False, False),
+    ("cbc_encrypt_into", True, True),
+    ("cbc_decrypt_into", False, True),
+)
+
+def gen_kernels(pkey):
+    """Compile round functions specialized for the key of pkey into pkey.encrypt_into etc.
+
+    The source is not kept, as it contains the subkeys; call gen_kernels_src(pkey) to inspect it."""
+
+    source = gen_kernels_src(pkey)
+    namespace = {"_check_buffers": _check_buffers, "_block": _block}
+    namespace.update(zip(("m0", "m1", "m2", "m3"), pkey.mk_tab))
+    if pkey.wide_tab is not None:
+        namespace.update(zip(("w0lo", "w0hi", "w1lo", "w1hi"), pkey.wide_tab))
+    code = compile(source, "<twofish specialized>", "exec")
+    del source
+    exec(code, namespace)
+    for (name, encrypt, cbc) in KERNELS:
+        setattr(pkey, name, namespace[name])
+
 __testkey = b'\xD4\x3B\xB7\x55\x6E\xA3\x2E\x46\xF2\xA2\x82\xB7\xD4\x5B\x4E\x0D\x57\xFF\x73\x9D\x4D\xC9\x2C\x1B\xD7\xFC\x01\x70\x0C\xC8\x21\x6F'
 __testdat = b'\x90\xAF\xE9\x1B\xB2\x88\x54\x4F\x2C\x32\xDC\x23\x9B\x26\x35\xE6'
 assert b'l\xb4V\x1c@\xbf\n\x97\x05\x93\x1c\xb6\xd4\x08\xe7\xfa' == Twofish(__testkey).encrypt(__testdat)
 assert __testdat == Twofish(__testkey).decrypt(b'l\xb4V\x1c@\xbf\n\x97\x05\x93\x1c\xb6\xd4\x08\xe7\xfa')
+# the specialized and wide-table variants are checked by bench.py, as building them takes much longer
 
@@ -17,22 +17,75 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #
 
-from . import twofish
-import operator
+from . import backend
+from . import twofish_numpy
+import os
+import struct
+import sys
+try:
+    import concurrent.futures as futures
+except ImportError:
+    futures = None
 
-import six
+_block = struct.Struct("<4L")
 
-class TwofishCBC:
+# number of workers to decrypt long ciphertexts with; 1 decrypts serially
+PARALLEL_WORKERS = int(os.environ.get("LOXODO_DECRYPT_WORKERS", "1"))
+
+# ciphertexts shorter than this many bytes are always decrypted serially
+PARALLEL_THRESHOLD = 1048576
+
+
+def _free_threaded():
+    """
+    Return True if this Python runs without the global interpreter lock.
+    """
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
+def _decrypt_shard(key, cipher_backend, init_vec, ciphertext):
+    """
+    Return the plaintext of a CBC ciphertext shard whose preceding ciphertext block is init_vec.
+    """
+    return TwofishCBC(key, init_vec, cipher_backend, workers=1).decrypt(ciphertext)
+
+
+class TwofishCBC(object):
     """
     Cipher-block chaining (CBC) Twofish operation mode.
     """
-    def __init__(self, key, init_vec=0):
+    def __init__(self, key, init_vec=0, cipher_backend=None, workers=None):
         """
         Set the key to be used for en-/de-cryption and optionally specify an initialization vector (aka seed/salt).
+
+        Ciphertexts of at least PARALLEL_THRESHOLD bytes are decrypted by the
+        given number of workers (default: PARALLEL_WORKERS, which can be set
+        via $LOXODO_DECRYPT_WORKERS). Workers are threads on free-threaded
+        Python builds and processes otherwise. Unless a backend is named (here
+        or in $LOXODO_CIPHER_BACKEND), ciphertexts (or shards) of at least
+        twofish_numpy.THRESHOLD bytes are decrypted by the NumPy engine, if
+        NumPy is installed.
         """
-        self.twofish = twofish.Twofish()
-        self.twofish.set_key(key)
+        self.twofish = backend.new_cipher(key, cipher_backend)
         self.state = init_vec
+        self.workers = workers if workers is not None else PARALLEL_WORKERS
+        self._key = key
+        self._cipher_backend = cipher_backend
+        self._auto = backend.auto_selected(cipher_backend)
+        self._vectorized = None
+
+    def _get_state(self):
+        return _block.pack(*self._chain)
+
+    def _set_state(self, value):
+        # the chaining state is kept as four 32-bit words; 0 means an all-zero initialization vector
+        if not value:
+            value = b"\x00" * 16
+        self._chain = _block.unpack(bytes(value))
+
+    # last ciphertext block (or the initialization vector); assign to resume a chain
+    state = property(_get_state, _set_state)
 
     def encrypt(self, plaintext):
         """
@@ -40,13 +93,9 @@ class TwofishCBC:
         """
         if len(plaintext) % 16:
             raise RuntimeError("Twofish ciphertext length must be a multiple of 16")
-        ciphertext = b""
-        while len(plaintext) >= 16:
-            block = self.twofish.encrypt(self._xor_block(plaintext[0:16], self.state))
-            ciphertext += block
-            plaintext = plaintext[16:]
-            self.state = block
-        return ciphertext
+        ciphertext = bytearray(len(plaintext))
+        self.encrypt_into(plaintext, ciphertext)
+        return bytes(ciphertext)
 
     def decrypt(self, ciphertext):
         """
@@ -54,26 +103,131 @@ class TwofishCBC:
         """
         if len(ciphertext) % 16:
             raise RuntimeError("Twofish ciphertext length must be a multiple of 16")
-        plaintext = b""
-        while len(ciphertext) >= 16:
-            block = ciphertext[0:16]
-            plaintext += self._xor_block(self.twofish.decrypt(block), self.state)
-            ciphertext = ciphertext[16:]
-            self.state = block
-        return plaintext
+        plaintext = bytearray(len(ciphertext))
+        self.decrypt_into(ciphertext, plaintext)
+        return bytes(plaintext)
 
-    @staticmethod
-    def _xor_block(text1, text2):
+    def encrypt_into(self, plaintext, buf):
         """
-        Return the bitwise xor of two arbitrary-length blocks of data
+        Encrypt the given buffer using Twofish CBC, writing the ciphertext to the writable buffer buf.
         """
-        return b"".join(
-                       map(
-                           lambda c1, c2: six.int2byte(operator.xor(six.byte2int([c1]), six.byte2int([c2]))),
-                           text1,
-                           text2
-                           )
-                       )
+        if len(plaintext) % 16:
+            raise RuntimeError("Twofish ciphertext length must be a multiple of 16")
+        self._chain = self.twofish.cbc_encrypt_into(plaintext, buf, self._chain)
+
+    def decrypt_into(self, ciphertext, buf):
+        """
+        Decrypt the given buffer using Twofish CBC, writing the plaintext to the writable buffer buf.
+        """
+        if len(ciphertext) % 16:
+            raise RuntimeError("Twofish ciphertext length must be a multiple of 16")
+        if futures is not None and self.workers > 1 and len(ciphertext) >= PARALLEL_THRESHOLD:
+            # each worker still uses the NumPy engine on its shard, if it applies
+            self._parallel_decrypt_into(ciphertext, buf)
+            return
+        cipher = self.twofish
+        if self._auto and len(ciphertext) >= twofish_numpy.THRESHOLD and twofish_numpy.available():
+            if self._vectorized is None:
+                self._vectorized = twofish_numpy.TwofishNumPy(self._key)
+            cipher = self._vectorized
+        self._chain = cipher.cbc_decrypt_into(ciphertext, buf, self._chain)
+
+    def _parallel_decrypt_into(self, ciphertext, buf):
+        """
+        Decrypt the given buffer in shards, each of which only needs the ciphertext block preceding it.
+        """
+        ciphertext = memoryview(ciphertext)
+        buf = memoryview(buf)
+        # taken before any shard is written, as buf may be the ciphertext itself
+        last_block = ciphertext[-16:].tobytes()
+        blocks = len(ciphertext) // 16
+        shard_len = ((blocks + self.workers - 1) // self.workers) * 16
+        if _free_threaded():
+            executor = futures.ThreadPoolExecutor(self.workers)
+        else:
+            executor = futures.ProcessPoolExecutor(self.workers)
+        with executor:
+            shards = []
+            for start in range(0, len(ciphertext), shard_len):
+                end = min(start + shard_len, len(ciphertext))
+                init_vec = self.state if start == 0 else ciphertext[start - 16:start].tobytes()
+                shard = executor.submit(_decrypt_shard, self._key, self._cipher_backend, init_vec,
+                                        ciphertext[start:end].tobytes())
+                shards.append((start, end, shard))
+            for (start, end, shard) in shards:
+                buf[start:end] = shard.result()
+        self.state = last_block
+
+
+class TwofishCBCStream(object):
+    """
+    Incremental Twofish CBC en- or decryption of input that arrives in chunks of arbitrary size.
+
+    Feed chunks to update() or update_into(); whole blocks are processed right
+    away and a trailing partial block is kept until the next chunk completes it.
+    Call finalize() once all input has been fed. There is no padding: the total
+    input length must be a multiple of 16.
+    """
+    def __init__(self, key, init_vec=0, decrypt=False, cipher_backend=None, workers=None):
+        self.cbc = TwofishCBC(key, init_vec, cipher_backend, workers)
+        if decrypt:
+            self._process_into = self.cbc.decrypt_into
+        else:
+            self._process_into = self.cbc.encrypt_into
+        self._pending = bytearray()
+        self._finalized = False
+
+    def output_len(self, chunk_len):
+        """
+        Return the number of bytes update() will produce for a chunk of the given length.
+        """
+        return (len(self._pending) + chunk_len) // 16 * 16
+
+    def update(self, chunk):
+        """
+        Process the given chunk and return the output of all blocks completed so far.
+        """
+        buf = bytearray(self.output_len(len(chunk)))
+        self.update_into(chunk, buf)
+        return bytes(buf)
+
+    def update_into(self, chunk, buf):
+        """
+        Process the given chunk, writing output to the writable buffer buf, and return the number of bytes written.
+        """
+        if self._finalized:
+            raise RuntimeError("Twofish CBC stream already finalized")
+        out_len = self.output_len(len(chunk))
+        if len(buf) < out_len:
+            raise RuntimeError("Twofish CBC output buffer too small")
+        chunk = memoryview(chunk)
+        buf = memoryview(buf)
+        written = 0
+        if self._pending:
+            # complete the block left over from the previous chunk
+            fill = min(16 - len(self._pending), len(chunk))
+            self._pending += chunk[:fill]
+            chunk = chunk[fill:]
+            if len(self._pending) < 16:
+                return 0
+            self._process_into(bytes(self._pending), buf[:16])
+            del self._pending[:]
+            written = 16
+        whole = len(chunk) // 16 * 16
+        if whole:
+            self._process_into(chunk[:whole], buf[written:written + whole])
+            written += whole
+        self._pending += chunk[whole:]
+        return written
+
+    def finalize(self):
+        """
+        End the stream. Raises RuntimeError if the input was not a multiple of 16 bytes long.
+        """
+        self._finalized = True
+        if self._pending:
+            raise RuntimeError("Twofish ciphertext length must be a multiple of 16")
+        return b""
 
 
 def test_twofish_cbc():
@@ -83,6 +237,12 @@ def test_twofish_cbc():
     __testdec = b"\x38\xd1\xe3\xb1\xe6\x0d\x41\xa7\xe7\xba\xf1\xeb\x34\x4b\xc3\xdb\x88\x38\xf5\x47\x41\x15\x3f\x26\xa4\x2d\x53\xd8\xd2\x80\x25\x0a\xf3\xe4\xbe\xe4\xba\xe1\xeb\x18\x18\x66\x8a\xa6\xe2\xd0\x2b\x6e\x62\x36\x91\xf7\x72\x28\x5e\xc6\x40\x89\x70\x91\x2c\x35\x71\x39"
     assert TwofishCBC(__testkey, __testivc).decrypt(__testenc) == __testdec
     assert TwofishCBC(__testkey, __testivc).encrypt(__testdec) == __testenc
+    stream = TwofishCBCStream(__testkey, __testivc, decrypt=True)
+    assert b"".join(stream.update(__testenc[i:i + 7]) for i in range(0, len(__testenc), 7)) + stream.finalize() == __testdec
+    stream = TwofishCBCStream(__testkey, __testivc)
+    buf = bytearray(len(__testdec))
+    assert stream.update_into(__testdec[:20], buf) == 16 and stream.update_into(__testdec[20:], memoryview(buf)[16:]) == 48
+    assert bytes(buf) == __testenc and stream.finalize() == b""
 
 
 test_twofish_cbc()
@@ -17,19 +17,36 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #
 
-from . import twofish
+from . import backend
+from . import twofish_numpy
 
 
 class TwofishECB:
     """
     Electronic codebook (ECB) Twofish operation mode.
     """
-    def __init__(self, key):
+    def __init__(self, key, cipher_backend=None):
         """
-        Set the key to be used for en-/de-cryption.
+        Set the key to be used for en-/de-cryption and optionally name the Twofish backend to use.
+
+        Unless a backend is named (here or in $LOXODO_CIPHER_BACKEND), inputs
+        of at least twofish_numpy.THRESHOLD bytes are processed by the NumPy
+        engine, if NumPy is installed.
+        """
+        self.twofish = backend.new_cipher(key, cipher_backend)
+        self._key = key
+        self._auto = backend.auto_selected(cipher_backend)
+        self._vectorized = None
+
+    def _cipher_for(self, text):
+        """
+        Return the NumPy engine for long inputs if available and no backend was named, the block cipher otherwise.
         """
-        self.twofish = twofish.Twofish()
-        self.twofish.set_key(key)
+        if self._auto and len(text) >= twofish_numpy.THRESHOLD and twofish_numpy.available():
+            if self._vectorized is None:
+                self._vectorized = twofish_numpy.TwofishNumPy(self._key)
+            return self._vectorized
+        return self.twofish
 
     def encrypt(self, plaintext):
         """
@@ -37,11 +54,7 @@ class TwofishECB:
         """
         if len(plaintext) % 16:
             raise RuntimeError("Twofish plaintext length must be a multiple of 16")
-        ciphertext = b""
-        while len(plaintext) >= 16:
-            ciphertext += self.twofish.encrypt(plaintext[0:16])
-            plaintext = plaintext[16:]
-        return ciphertext
+        return self._cipher_for(plaintext).encrypt(plaintext)
 
     def decrypt(self, ciphertext):
         """
@@ -49,11 +62,7 @@ class TwofishECB:
         """
         if len(ciphertext) % 16:
             raise RuntimeError("Twofish ciphertext length must be a multiple of 16")
-        plaintext = b""
-        while len(ciphertext) >= 16:
-            plaintext += self.twofish.decrypt(ciphertext[0:16])
-            ciphertext = ciphertext[16:]
-        return plaintext
+        return self._cipher_for(ciphertext).decrypt(ciphertext)
 
 
 def test_twofish_ecb():
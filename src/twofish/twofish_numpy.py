@@ -0,0 +1,172 @@
+#
+# Loxodo -- Password Safe V3 compatible Password Vault
+# Copyright (C) 2008 Christoph Sommer <mail@christoph-sommer.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+"""
+Twofish on many blocks at once, using NumPy.
+
+All blocks of the input go through the 16 Feistel rounds together: each of the
+four state words is a uint32 array with one element per block, and the
+key-dependent S-box lookups are gathers from the mk_tab arrays. This only pays
+off for modes that can process blocks independently, i.e. ECB and CBC
+decryption, and only for inputs of more than a few hundred blocks.
+
+NumPy is optional, and only imported on the first call of available(); check
+it before use.
+"""
+
+from . import twofish
+
+# the numpy module, once available() found it
+numpy = None
+_imported = False
+
+# inputs shorter than this many bytes are faster with the block-by-block code
+THRESHOLD = 4096
+
+
+def available():
+    """
+    Return True if NumPy could be imported, importing it on the first call.
+    """
+    global numpy, _imported
+    if not _imported:
+        _imported = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy is not None
+
+
+class TwofishNumPy(object):
+    """
+    Twofish block cipher with the bulk interface of twofish.Twofish, vectorized over all blocks.
+    """
+    def __init__(self, key):
+        if not available():
+            raise ImportError("NumPy is not available")
+        self.scalar = twofish.Twofish(key)
+        context = self.scalar.context
+        self.mk_tab = [numpy.array(tab, dtype=numpy.uint32) for tab in context.mk_tab]
+        self.l_key = [numpy.uint32(k) for k in context.l_key]
+
+    def encrypt(self, block):
+        ciphertext = bytearray(len(block))
+        self.encrypt_into(block, ciphertext)
+        return bytes(ciphertext)
+
+    def decrypt(self, block):
+        plaintext = bytearray(len(block))
+        self.decrypt_into(block, plaintext)
+        return bytes(plaintext)
+
+    def encrypt_into(self, src, dst):
+        self._check_buffers(src, dst)
+        if len(src):
+            self._output(dst, self._crypt(self._input(src), encrypt=True))
+
+    def decrypt_into(self, src, dst):
+        self._check_buffers(src, dst)
+        if len(src):
+            self._output(dst, self._crypt(self._input(src), encrypt=False))
+
+    def cbc_encrypt_into(self, src, dst, iv):
+        # every block depends on the previous one, so there is nothing to vectorize
+        return self.scalar.cbc_encrypt_into(src, dst, iv)
+
+    def cbc_decrypt_into(self, src, dst, iv):
+        self._check_buffers(src, dst)
+        if not len(src):
+            return iv
+        words = self._input(src)
+        plaintext = self._crypt(words, encrypt=False)
+        plaintext[0] ^= numpy.array(iv, dtype=numpy.uint32)
+        plaintext[1:] ^= words[:-1]
+        self._output(dst, plaintext)
+        return tuple(int(x) for x in words[-1])
+
+    @staticmethod
+    def _check_buffers(src, dst):
+        if len(src) % 16:
+            raise ValueError("block size must be a multiple of 16")
+        if len(dst) < len(src):
+            raise ValueError("output buffer too small")
+
+    @staticmethod
+    def _input(src):
+        # copy the input, so that src and dst may overlap
+        return numpy.frombuffer(src, dtype="<u4").astype(numpy.uint32).reshape(-1, 4)
+
+    @staticmethod
+    def _output(dst, words):
+        out = numpy.frombuffer(dst, dtype=numpy.uint8, count=words.size * 4).view("<u4")
+        out[:] = words.reshape(-1)
+
+    def _g0(self, x):
+        m0, m1, m2, m3 = self.mk_tab
+        return m0[x & 0xff] ^ m1[(x >> 8) & 0xff] ^ m2[(x >> 16) & 0xff] ^ m3[x >> 24]
+
+    def _g1(self, x):
+        m0, m1, m2, m3 = self.mk_tab
+        return m0[x >> 24] ^ m1[x & 0xff] ^ m2[(x >> 8) & 0xff] ^ m3[(x >> 16) & 0xff]
+
+    def _crypt(self, words, encrypt):
+        """
+        Return the en- or decryption of an (n, 4) array of little-endian block words.
+        """
+        k = self.l_key
+        g0 = self._g0
+        g1 = self._g1
+
+        if encrypt:
+            a = words[:, 0] ^ k[0]
+            b = words[:, 1] ^ k[1]
+            c = words[:, 2] ^ k[2]
+            d = words[:, 3] ^ k[3]
+            for i in range(8, 40, 4):
+                t1 = g1(b)
+                t0 = g0(a)
+                c ^= t0 + t1 + k[i]
+                c = (c >> 1) | (c << 31)
+                d = ((d << 1) | (d >> 31)) ^ (t0 + (t1 << 1) + k[i + 1])
+                t1 = g1(d)
+                t0 = g0(c)
+                a ^= t0 + t1 + k[i + 2]
+                a = (a >> 1) | (a << 31)
+                b = ((b << 1) | (b >> 31)) ^ (t0 + (t1 << 1) + k[i + 3])
+            out_keys = k[4:8]
+        else:
+            a = words[:, 0] ^ k[4]
+            b = words[:, 1] ^ k[5]
+            c = words[:, 2] ^ k[6]
+            d = words[:, 3] ^ k[7]
+            for i in range(36, 4, -4):
+                t1 = g1(b)
+                t0 = g0(a)
+                c = ((c << 1) | (c >> 31)) ^ (t0 + t1 + k[i + 2])
+                d ^= t0 + (t1 << 1) + k[i + 3]
+                d = (d >> 1) | (d << 31)
+                t1 = g1(d)
+                t0 = g0(c)
+                a = ((a << 1) | (a >> 31)) ^ (t0 + t1 + k[i])
+                b ^= t0 + (t1 << 1) + k[i + 1]
+                b = (b >> 1) | (b << 31)
+            out_keys = k[0:4]
+
+        return numpy.stack((c ^ out_keys[0], d ^ out_keys[1], a ^ out_keys[2], b ^ out_keys[3]), axis=1)
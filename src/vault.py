@@ -18,7 +18,10 @@
 #
 
 import hashlib
+import itertools
 import struct
+from array import array
+from collections import OrderedDict
 from hmac import HMAC
 import random
 import os
@@ -28,7 +31,66 @@ import uuid
 import six
 
 from .twofish.twofish_ecb import TwofishECB
-from .twofish.twofish_cbc import TwofishCBC
+from .twofish.twofish_cbc import TwofishCBC, TwofishCBCStream
+
+class _HashingFile(object):
+    """
+    Wraps a writable file, keeping the SHA-256 of everything written to it.
+    """
+    def __init__(self, filehandle):
+        self.filehandle = filehandle
+        self.sha = hashlib.sha256()
+        self.length = 0
+
+    def write(self, data):
+        self.sha.update(data)
+        self.length += len(data)
+        self.filehandle.write(data)
+
+    def close(self):
+        self.filehandle.flush()
+        os.fsync(self.filehandle.fileno())
+        self.filehandle.close()
+
+
+def _file_digest(filename):
+    """
+    Return the length and SHA-256 of the contents of the given file.
+    """
+    sha = hashlib.sha256()
+    length = 0
+    with open(filename, 'rb') as filehandle:
+        while True:
+            data = filehandle.read(1048576)
+            if not data:
+                break
+            sha.update(data)
+            length += len(data)
+    return (length, sha.digest())
+
+
+def _create_temporary(filename):
+    """
+    Create a temporary file next to the given one and return its name and a _HashingFile writing to it.
+    """
+    (osfilehandle, tmpfilename) = tempfile.mkstemp('.part', os.path.basename(filename) + ".", os.path.dirname(filename), text=False)
+    return (tmpfilename, _HashingFile(os.fdopen(osfilehandle, "wb")))
+
+
+def _replace_file(tmpfilename, filename):
+    """
+    Replace the given file with the temporary one and remove its journal, which does not apply to the new file.
+    """
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+    os.rename(tmpfilename, filename)
+    try:
+        os.remove(Vault.journal_filename(filename))
+    except OSError:
+        pass
+
 
 class Vault(object):
     """
@@ -37,7 +99,14 @@ class Vault(object):
     The on-disk represenation of the Vault is described in the following file:
     http://passwordsafe.svn.sourceforge.net/viewvc/passwordsafe/trunk/pwsafe/pwsafe/docs/formatV3.txt?revision=2139
     """
-    def __init__(self, password, filename=None):
+    def __init__(self, password, filename=None, key_material=None):
+        """
+        Create an empty Vault or load one from the given file.
+
+        Key material of another Vault (see KeyMaterial) may be passed in to avoid
+        stretching the same password again; it is only used if password, salt and
+        iteration count match.
+        """
 
         assert type(password) == six.text_type
 
@@ -52,11 +121,18 @@ class Vault(object):
         self.f_iv = None
         self.f_hmac = None
         self.header = self.Header()
-        self.records = []
+        self.records = self.RecordList()
+        self._keys = None
+        self._columns = None
+        self._saved = None
+        # id(Record) -> (Record, revision, UUID) as stored in the file plus its journal, in file order
+        self._synced = OrderedDict()
+        # (number of entries, length) of the journal as last read or written; None if there is no usable one
+        self._journal = None
         if not filename:
             self._create_empty(password.encode('utf_8', 'replace'))
         else:
-            self._read_from_file(filename, password.encode('utf_8', 'replace'))
+            self._read_from_file(filename, password.encode('utf_8', 'replace'), key_material)
 
     class BadPasswordError(RuntimeError):
         pass
@@ -67,17 +143,130 @@ class Vault(object):
     class VaultVersionError(VaultFormatError):
         pass
 
+    class KeyMaterial(object):
+        """
+        Keys derived from a Vault's password, kept for the session so that saving does not stretch the password again.
+
+        Holds the stretched password P', its hash H(P'), the keys K and L, and
+        the Twofish contexts made from them. Call wipe() once they are no longer
+        needed: key bytes are overwritten and cipher contexts are dropped.
+        """
+        def __init__(self, password, salt, iterations):
+
+            assert type(password) == six.binary_type
+
+            self.password = bytearray(password)
+            self.salt = salt
+            self.iterations = iterations
+            stretched_password = Vault._stretch_password(password, salt, iterations)
+            self.stretched_password = bytearray(stretched_password)
+            self.sha_ps = hashlib.sha256(stretched_password).digest()
+            self.ecb = TwofishECB(stretched_password)
+            self.blocks = None
+            self.key_k = None
+            self.key_l = None
+            self._cbc = None
+
+        def matches(self, password, salt, iterations):
+            """
+            Return True if this key material was derived from the given password, salt and iteration count.
+            """
+            return self.password is not None and bytes(self.password) == password and self.salt == salt and self.iterations == iterations
+
+        def set_blocks(self, b1, b2, b3, b4):
+            """
+            Derive K and L from the encrypted blocks B1-B4, unless already done.
+            """
+            if self.blocks == (b1, b2, b3, b4):
+                return
+            self._wipe_keys()
+            self.blocks = (b1, b2, b3, b4)
+            self.key_k = bytearray(self.ecb.decrypt(b1) + self.ecb.decrypt(b2))
+            self.key_l = bytearray(self.ecb.decrypt(b3) + self.ecb.decrypt(b4))
+
+        def new_cbc(self, init_vec):
+            """
+            Return the Twofish CBC context of key K, reset to the given initialization vector.
+            """
+            if self._cbc is None:
+                self._cbc = TwofishCBC(bytes(self.key_k))
+            self._cbc.state = init_vec
+            return self._cbc
+
+        def new_hmac(self):
+            """
+            Return a new HMAC-SHA-256 of key L.
+            """
+            return HMAC(bytes(self.key_l), b"", hashlib.sha256)
+
+        def _wipe_keys(self):
+            for key in (self.key_k, self.key_l):
+                if key is not None:
+                    key[:] = b"\x00" * len(key)
+            self.blocks = None
+            self.key_k = None
+            self.key_l = None
+            self._cbc = None
+
+        def wipe(self):
+            """
+            Overwrite all key bytes and drop the cipher contexts.
+            """
+            self._wipe_keys()
+            for secret in (self.password, self.stretched_password):
+                if secret is not None:
+                    secret[:] = b"\x00" * len(secret)
+            self.password = None
+            self.stretched_password = None
+            self.sha_ps = None
+            self.ecb = None
+
     class Field(object):
         """
         Contains the raw, on-disk representation of a record's field.
         """
+        __slots__ = ("raw_type", "raw_len", "_raw_value", "_buffer", "_offset")
+
         def __init__(self, raw_type, raw_len, raw_value):
 
             assert type(raw_value) == six.binary_type
 
             self.raw_type = raw_type
             self.raw_len = raw_len
-            self.raw_value = raw_value
+            self._raw_value = raw_value
+            self._buffer = None
+            self._offset = 0
+
+        @staticmethod
+        def from_buffer(raw_type, raw_len, buf, offset):
+            """
+            Return a Field whose value is raw_len bytes of the memoryview buf at offset, copied only when first accessed.
+            """
+            field = Vault.Field(raw_type, raw_len, b"")
+            field._raw_value = None
+            field._buffer = buf
+            field._offset = offset
+            return field
+
+        def view(self):
+            """
+            Return the raw value without copying it out of the buffer it was parsed from.
+            """
+            if self._raw_value is None:
+                return self._buffer[self._offset:self._offset + self.raw_len]
+            return self._raw_value
+
+        def _get_raw_value(self):
+            if self._raw_value is None:
+                self._raw_value = self.view().tobytes()
+                self._buffer = None
+            return self._raw_value
+
+        def _set_raw_value(self, value):
+            self._raw_value = value
+            self._buffer = None
+
+        raw_value = property(_get_raw_value, _set_raw_value)
 
         def is_equal(self, field):
             """
@@ -89,6 +278,8 @@ class Vault(object):
         """
         Contains the fields of a Vault header.
         """
+        __slots__ = ("raw_fields",)
+
         def __init__(self):
             self.raw_fields = {}
 
@@ -99,16 +290,29 @@ class Vault(object):
         """
         Contains the fields of an individual password record.
         """
+        # raw field type -> slot holding its decoded value; a slot is only set once the value was first accessed
+        _SLOTS = {
+            0x01: "_uuid",
+            0x02: "_group",
+            0x03: "_title",
+            0x04: "_user",
+            0x05: "_notes",
+            0x06: "_passwd",
+            0x0c: "_last_mod",
+            0x0d: "_url",
+        }
+
+        __slots__ = ("raw_fields", "revision", "_owners") + tuple(_SLOTS.values())
+
+        # incremented whenever any Record's fields change, so that Vault.columns() knows when to rebuild
+        _changes = 0
+
         def __init__(self):
             self.raw_fields = {}
-            self._uuid = None
-            self._group = u""
-            self._title = u""
-            self._user = u""
-            self._notes = u""
-            self._passwd = u""
-            self._last_mod = 0
-            self._url = u""
+            # incremented whenever this Record's fields change
+            self.revision = 0
+            # the RecordLists this Record is part of, which index it by UUID
+            self._owners = ()
 
         @staticmethod
         def create():
@@ -118,23 +322,47 @@ class Vault(object):
             return record
 
         def add_raw_field(self, raw_field):
+            old_uuid = self.uuid if self._owners and raw_field.raw_type == 0x01 else None
             self.raw_fields[raw_field.raw_type] = raw_field
-            if (raw_field.raw_type == 0x01):
-                self._uuid = uuid.UUID(bytes_le=raw_field.raw_value)
-            if (raw_field.raw_type == 0x02):
-                self._group = raw_field.raw_value.decode('utf_8', 'replace')
-            if (raw_field.raw_type == 0x03):
-                self._title = raw_field.raw_value.decode('utf_8', 'replace')
-            if (raw_field.raw_type == 0x04):
-                self._user = raw_field.raw_value.decode('utf_8', 'replace')
-            if (raw_field.raw_type == 0x05):
-                self._notes = raw_field.raw_value.decode('utf_8', 'replace')
-            if (raw_field.raw_type == 0x06):
-                self._passwd = raw_field.raw_value.decode('utf_8', 'replace')
-            if ((raw_field.raw_type == 0x0c) and (raw_field.raw_len == 4)):
-                self._last_mod = struct.unpack("<L", raw_field.raw_value)[0]
-            if (raw_field.raw_type == 0x0d):
-                self._url = raw_field.raw_value.decode('utf_8', 'replace')
+            self._forget(raw_field.raw_type)
+            self.revision += 1
+            Vault.Record._changes += 1
+            if self._owners and raw_field.raw_type == 0x01:
+                self._rekey(old_uuid)
+
+        def _rekey(self, old_uuid):
+            """
+            Tell the RecordLists this Record is part of that its UUID changed from old_uuid.
+            """
+            for owner in self._owners:
+                owner._rekey(self, old_uuid)
+
+        def _forget(self, raw_id):
+            """
+            Drop the decoded value of the field of the given type, if any.
+            """
+            slot = self._SLOTS.get(raw_id)
+            if slot is not None and hasattr(self, slot):
+                delattr(self, slot)
+
+        def _decode(self, raw_id):
+            """
+            Return the value of the field of the given type, decoding its raw value on first access.
+            """
+            slot = self._SLOTS[raw_id]
+            try:
+                return getattr(self, slot)
+            except AttributeError:
+                pass
+            field = self.raw_fields.get(raw_id)
+            if raw_id == 0x01:
+                value = uuid.UUID(bytes_le=field.raw_value) if field is not None else None
+            elif raw_id == 0x0c:
+                value = struct.unpack("<L", field.raw_value)[0] if field is not None and field.raw_len == 4 else 0
+            else:
+                value = field.raw_value.decode('utf_8', 'replace') if field is not None else u""
+            setattr(self, slot, value)
+            return value
 
         def mark_modified(self):
             self.last_mod = int(time.time())
@@ -142,9 +370,10 @@ class Vault(object):
         # TODO: refactor Record._set_xyz methods to be less repetitive
 
         def _get_uuid(self):
-            return self._uuid
+            return self._decode(0x01)
 
         def _set_uuid(self, value):
+            old_uuid = self.uuid if self._owners else None
             self._uuid = value
             raw_id = 0x01
             if (raw_id not in self.raw_fields):
@@ -152,9 +381,11 @@ class Vault(object):
             self.raw_fields[raw_id].raw_value = value.bytes_le
             self.raw_fields[raw_id].raw_len = len(self.raw_fields[raw_id].raw_value)
             self.mark_modified()
+            if self._owners:
+                self._rekey(old_uuid)
 
         def _get_group(self):
-            return self._group
+            return self._decode(0x02)
 
         def _set_group(self, value):
 
@@ -169,7 +400,7 @@ class Vault(object):
             self.mark_modified()
 
         def _get_title(self):
-            return self._title
+            return self._decode(0x03)
 
         def _set_title(self, value):
 
@@ -184,7 +415,7 @@ class Vault(object):
             self.mark_modified()
 
         def _get_user(self):
-            return self._user
+            return self._decode(0x04)
 
         def _set_user(self, value):
 
@@ -199,7 +430,7 @@ class Vault(object):
             self.mark_modified()
 
         def _get_notes(self):
-            return self._notes
+            return self._decode(0x05)
 
         def _set_notes(self, value):
 
@@ -214,7 +445,7 @@ class Vault(object):
             self.mark_modified()
 
         def _get_passwd(self):
-            return self._passwd
+            return self._decode(0x06)
 
         def _set_passwd(self, value):
 
@@ -229,11 +460,13 @@ class Vault(object):
             self.mark_modified()
 
         def _get_last_mod(self):
-            return self._last_mod
+            return self._decode(0x0c)
 
         def _set_last_mod(self, value):
             assert type(value) == int
             self._last_mod = value
+            self.revision += 1
+            Vault.Record._changes += 1
             raw_id = 0x0c
             if (raw_id not in self.raw_fields):
                 self.raw_fields[raw_id] = Vault.Field(raw_id, 0, b"0")
@@ -241,7 +474,7 @@ class Vault(object):
             self.raw_fields[raw_id].raw_len = len(self.raw_fields[raw_id].raw_value)
 
         def _get_url(self):
-            return self._url
+            return self._decode(0x0d)
 
         def _set_url(self, value):
 
@@ -269,13 +502,26 @@ class Vault(object):
             """
             return self.last_mod > record.last_mod
 
+        def is_equal(self, record):
+            """
+            Return True if this Record and the given one contain the same fields with the same values.
+            """
+            if set(self.raw_fields) != set(record.raw_fields):
+                return False
+            return all(field.is_equal(record.raw_fields[raw_id]) for (raw_id, field) in self.raw_fields.items())
+
         def merge(self, record):
             """
             Merge in fields from another Record, replacing existing ones
             """
+            old_uuid = self.uuid if self._owners else None
+            for raw_id in self.raw_fields:
+                self._forget(raw_id)
             self.raw_fields = {}
             for field in record.raw_fields.values():
                 self.add_raw_field(field)
+            if self._owners:
+                self._rekey(old_uuid)
 
 
         uuid = property(_get_uuid, _set_uuid)
@@ -291,7 +537,353 @@ class Vault(object):
             """
             Compare Based on Group, then by Title
             """
-            return cmp(self._group+self._title, other._group+other._title)
+            return cmp(self.group+self.title, other.group+other.title)
+
+    class SavedState(object):
+        """
+        What was last read from or written to a file, so that the next save can reuse the unchanged part of it.
+
+        Checkpoints are (record count, file offset, CBC state, HMAC) tuples at
+        the end of the header and after every CHECKPOINT_INTERVAL-th and the
+        last record: everything up to such a file offset can be copied as is
+        if neither the header nor any of the preceding Records changed.
+        """
+        def __init__(self, vault, filename, length, digest, checkpoints):
+            self.filename = os.path.abspath(filename)
+            self.length = length
+            self.digest = digest
+            self.keys = vault._keys
+            self.iv = vault.f_iv
+            self.header = Vault.SavedState._header_snapshot(vault)
+            self.records = list(vault.records)
+            self.revisions = [record.revision for record in self.records]
+            self.checkpoints = checkpoints
+
+        @staticmethod
+        def _header_snapshot(vault):
+            return [(raw_id, field.raw_value) for (raw_id, field) in vault.header.raw_fields.items()]
+
+        def unchanged_records(self, vault, filename):
+            """
+            Return how many of the vault's leading Records are unchanged since then, or None if nothing can be reused.
+            """
+            if (os.path.abspath(filename) != self.filename or vault._keys is not self.keys or vault.f_iv != self.iv
+                    or Vault.SavedState._header_snapshot(vault) != self.header):
+                return None
+            count = 0
+            for (record, saved_record, revision) in zip(vault.records, self.records, self.revisions):
+                if record is not saved_record or record.revision != revision:
+                    break
+                count += 1
+            return count
+
+    class RecordList(object):
+        """
+        The Records of a Vault in file order, indexed by UUID.
+
+        Behaves like a list of Records for iteration, len(), append() and
+        remove(), but removing, replacing and looking up a Record by UUID take
+        constant time. Records tell the lists they are part of when their UUID
+        changes, so that the index stays current. Of several Records with the
+        same UUID, lookups return the first one in file order.
+        """
+        def __init__(self, records=()):
+            # position token -> Record, in file order
+            self._records = OrderedDict()
+            # id(Record) -> its position token
+            self._tokens = {}
+            # UUID -> Records with that UUID, in file order; built on first lookup, so that loading does not decode every UUID
+            self._by_uuid = None
+            self._next_token = itertools.count()
+            # incremented whenever Records are added, removed or replaced
+            self.mutations = 0
+            self.extend(records)
+
+        def __len__(self):
+            return len(self._records)
+
+        def __iter__(self):
+            return iter(list(self._records.values()))
+
+        def __contains__(self, record):
+            return id(record) in self._tokens
+
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                return list(self._records.values())[index]
+            if index < 0:
+                index += len(self._records)
+            if not 0 <= index < len(self._records):
+                raise IndexError("record index out of range")
+            return next(itertools.islice(six.itervalues(self._records), index, None))
+
+        def _index(self, record):
+            if self._by_uuid is None or record.uuid is None:
+                return
+            bucket = self._by_uuid.setdefault(record.uuid, [])
+            if any(other is record for other in bucket):
+                return
+            # keep the bucket in file order
+            token = self._tokens[id(record)]
+            position = len(bucket)
+            while position and self._tokens[id(bucket[position - 1])] > token:
+                position -= 1
+            bucket.insert(position, record)
+
+        def _unindex(self, record, record_uuid):
+            if self._by_uuid is None or record_uuid is None:
+                return
+            bucket = self._by_uuid.get(record_uuid)
+            if bucket is None:
+                return
+            bucket[:] = [other for other in bucket if other is not record]
+            if not bucket:
+                del self._by_uuid[record_uuid]
+
+        def _rekey(self, record, old_uuid):
+            if old_uuid != record.uuid:
+                self._unindex(record, old_uuid)
+                self._index(record)
+
+        def _add(self, record, token):
+            if id(record) in self._tokens:
+                raise ValueError("Record is already part of this Vault")
+            self._records[token] = record
+            self._tokens[id(record)] = token
+            record._owners += (self,)
+            self._index(record)
+
+        def _drop(self, record):
+            del self._tokens[id(record)]
+            record._owners = tuple(owner for owner in record._owners if owner is not self)
+            self._unindex(record, record.uuid)
+
+        def append(self, record):
+            """
+            Add the given Record at the end.
+            """
+            self._add(record, next(self._next_token))
+            self.mutations += 1
+
+        def extend(self, records):
+            for record in records:
+                self.append(record)
+
+        def remove(self, record):
+            """
+            Remove the given Record.
+            """
+            token = self._tokens.get(id(record))
+            if token is None:
+                raise ValueError("Record is not part of this Vault")
+            del self._records[token]
+            self._drop(record)
+            self.mutations += 1
+
+        def get(self, record_uuid, default=None):
+            """
+            Return the Record with the given UUID, or default.
+            """
+            if self._by_uuid is None:
+                self._reindex()
+            bucket = self._by_uuid.get(record_uuid)
+            if not bucket:
+                return default
+            return bucket[0]
+
+        def delete(self, record_uuid):
+            """
+            Remove and return the Record with the given UUID. Raises KeyError if there is none.
+            """
+            record = self.get(record_uuid)
+            if record is None:
+                raise KeyError(record_uuid)
+            self.remove(record)
+            return record
+
+        def replace(self, record):
+            """
+            Put the given Record in place of the one with the same UUID, keeping its position. Returns the replaced Record.
+            """
+            old_record = self.get(record.uuid)
+            if old_record is None:
+                raise KeyError(record.uuid)
+            self._swap(old_record, record)
+            return old_record
+
+        def put(self, record):
+            """
+            Replace the Record with the same UUID by the given one, or append it if there is none. Returns the replaced Record or None.
+            """
+            old_record = self.get(record.uuid)
+            if old_record is None:
+                self.append(record)
+            else:
+                self._swap(old_record, record)
+            return old_record
+
+        def _swap(self, old_record, record):
+            if old_record is record:
+                return
+            if id(record) in self._tokens:
+                raise ValueError("Record is already part of this Vault")
+            token = self._tokens[id(old_record)]
+            self._drop(old_record)
+            self._add(record, token)
+            self.mutations += 1
+
+        def _reindex(self):
+            self._by_uuid = {}
+            for record in self._records.values():
+                if record.uuid is not None:
+                    self._by_uuid.setdefault(record.uuid, []).append(record)
+
+    class Columns(object):
+        """
+        Column-wise copy of the fields of a list of Records, for searching and sorting many Records at once.
+
+        Each column is a list with one (interned) value per Record, or an
+        array('L') for last_mod. Columns are built when first used; results are
+        lists of row indices into the records attribute.
+        """
+        def __init__(self, records):
+            self.records = list(records)
+            self.changes = Vault.Record._changes
+            self.mutations = records.mutations
+            self._columns = {}
+            self._lower_columns = {}
+            self._interned = {}
+            self._haystacks = {}
+
+        def __len__(self):
+            return len(self.records)
+
+        def is_current(self, records):
+            """
+            Return True if these columns still reflect the given RecordList.
+            """
+            return self.changes == Vault.Record._changes and self.mutations == records.mutations
+
+        def column(self, name):
+            """
+            Return the values of the given Record property (e.g. "title") for all rows.
+            """
+            if name not in self._columns:
+                values = [getattr(record, name) for record in self.records]
+                if name == "last_mod":
+                    values = array("L", values)
+                elif name != "uuid":
+                    intern = self._interned.setdefault
+                    values = [intern(value, value) for value in values]
+                self._columns[name] = values
+            return self._columns[name]
+
+        def lower_column(self, name):
+            """
+            Return the lower-cased values of the given text column.
+            """
+            if name not in self._lower_columns:
+                intern = self._interned.setdefault
+                self._lower_columns[name] = [intern(value, value) for value in map(six.text_type.lower, self.column(name))]
+            return self._lower_columns[name]
+
+        def search(self, text, names, ignore_case=True):
+            """
+            Return the indices of all rows for which any of the given columns contains text.
+            """
+            if ignore_case:
+                text = text.lower()
+            if u"\x00" in text:
+                return []
+            key = (tuple(names), ignore_case)
+            if key not in self._haystacks:
+                # one string per row, with the values of all columns separated by NUL
+                if ignore_case:
+                    columns = [self.lower_column(name) for name in names]
+                else:
+                    columns = [self.column(name) for name in names]
+                self._haystacks[key] = [u"\x00".join(values) for values in zip(*columns)]
+            return [row for (row, haystack) in enumerate(self._haystacks[key]) if text in haystack]
+
+        def match(self, pattern, names):
+            """
+            Return the indices of all rows for which the compiled regular expression matches any of the given columns.
+            """
+            columns = [self.column(name) for name in names]
+            return [row for (row, values) in enumerate(zip(*columns)) if any(pattern.match(value) for value in values)]
+
+        def sort(self, rows, name, ignore_case=True):
+            """
+            Return the given row indices, sorted by the given column.
+            """
+            values = self.lower_column(name) if ignore_case else self.column(name)
+            return sorted(rows, key=values.__getitem__)
+
+        def rows(self, rows):
+            """
+            Return the Records of the given row indices.
+            """
+            return [self.records[row] for row in rows]
+
+    def columns(self):
+        """
+        Return a Vault.Columns view of this Vault's records, rebuilt if records were added, removed or changed since it was last returned.
+        """
+        if self._columns is None or not self._columns.is_current(self.records):
+            self._columns = self.Columns(self.records)
+        return self._columns
+
+    def plan_merge(self, other):
+        """
+        Return a list of (action, my_record, other_record) tuples that describe how to merge another Vault into this one.
+
+        Records correspond if they have the same UUID or, if either one has no
+        UUID, the same title (see Record.is_corresponding); the first
+        corresponding Record of this Vault is used. Actions are "new" (no
+        corresponding Record; my_record is None), "update" (other_record is
+        newer) and "conflict" (other_record is not newer, but its fields
+        differ). Identical Records are left out. Runs in linear time.
+        """
+        # first position of each UUID, of each title of a Record without UUID, and of each title
+        by_uuid = {}
+        by_title_without_uuid = {}
+        by_title = {}
+        records = list(self.records)
+        for (position, record) in enumerate(records):
+            if record.uuid:
+                by_uuid.setdefault(record.uuid, position)
+            else:
+                by_title_without_uuid.setdefault(record.title, position)
+            by_title.setdefault(record.title, position)
+
+        plan = []
+        for other_record in other.records:
+            if other_record.uuid:
+                candidates = [by_uuid.get(other_record.uuid), by_title_without_uuid.get(other_record.title)]
+                candidates = [position for position in candidates if position is not None]
+                position = min(candidates) if candidates else None
+            else:
+                position = by_title.get(other_record.title)
+
+            if position is None:
+                plan.append(("new", None, other_record))
+                continue
+            my_record = records[position]
+            if other_record.is_newer_than(my_record):
+                plan.append(("update", my_record, other_record))
+            elif not my_record.is_equal(other_record):
+                plan.append(("conflict", my_record, other_record))
+        return plan
+
+    def apply_merge(self, plan):
+        """
+        Carry out the given (action, my_record, other_record) tuples of plan_merge: add new Records, merge the others.
+        """
+        for (action, my_record, other_record) in plan:
+            if my_record is None:
+                self.records.append(other_record)
+            else:
+                my_record.merge(other_record)
 
     @staticmethod
     def _stretch_password(password, salt, iterations):
@@ -312,27 +904,33 @@ class Vault(object):
             stretched_password = hashlib.sha256(stretched_password).digest()
         return stretched_password
 
-    def _read_field_tlv(self, filehandle, cipher):
+    @staticmethod
+    def _field_at(plaintext, offset):
         """
-        Return one field of a vault record by reading from the given file handle.
+        Return (raw_type, raw_len, field_end) of the field at the given offset of decrypted header and records.
+
+        The field, which is padded to a multiple of 16 bytes, ends at field_end,
+        which may lie beyond the end of the buffer if the field is incomplete.
         """
-        data = filehandle.read(16)
-        if (not data) or (len(data) < 16):
-            raise self.VaultFormatError("EOF encountered when parsing record field")
-        if data == b"PWS3-EOFPWS3-EOF":
-            return None
-        data = cipher.decrypt(data)
-        raw_len = struct.unpack("<L", data[0:4])[0]
-        raw_type = six.byte2int([data[4]])
-        raw_value = data[5:]
+        (raw_len, raw_type) = struct.unpack_from("<LB", plaintext, offset)
+        field_end = offset + 16
         if (raw_len > 11):
-            for dummy in range((raw_len+4)//16):
-                data = filehandle.read(16)
-                if (not data) or (len(data) < 16):
-                    raise self.VaultFormatError("EOF encountered when parsing record field")
-                raw_value += cipher.decrypt(data)
-        raw_value = raw_value[:raw_len]
-        return self.Field(raw_type, raw_len, raw_value)
+            field_end += ((raw_len+4)//16) * 16
+        return (raw_type, raw_len, field_end)
+
+    def _parse_tlv(self, plaintext):
+        """
+        Yield (raw_type, offset, raw_len) of each field in the given buffer of decrypted header and records.
+        """
+        field_at = self._field_at
+        end = len(plaintext)
+        offset = 0
+        while offset < end:
+            (raw_type, raw_len, field_end) = field_at(plaintext, offset)
+            if field_end > end:
+                raise self.VaultFormatError("EOF encountered when parsing record field")
+            yield (raw_type, offset + 5, raw_len)
+            offset = field_end
 
     @staticmethod
     def _urandom(count):
@@ -344,13 +942,62 @@ class Vault(object):
                 retval += struct.pack("<B", random.randint(0, 0xFF))
             return retval
 
-    def _write_field_tlv(self, filehandle, cipher, field):
+    def _serialize(self, head, groups, hmac_checker, record_count):
+        """
+        Return a buffer with head, the unencrypted TLV blocks of the given fields and room for the EOF block and HMAC.
+
+        groups is a list of (record count, fields) tuples, each of which is
+        followed by an end-of-record field. The HMAC is updated with all field
+        values. Also returns where the fields end, and (record count, offset,
+        HMAC copy) at the end of the header (count 0), of every
+        CHECKPOINT_INTERVAL-th and of the last Record.
         """
-        Write one field of a vault record using the given file handle.
+        # padding of each field to the next block boundary, plus a block per end-of-record field
+        padding = 0
+        body_len = 0
+        for (count, fields) in groups:
+            for field in fields:
+                field_len = (field.raw_len + 5 + 15) // 16 * 16
+                padding += field_len - 5 - field.raw_len
+                body_len += field_len
+            padding += 11
+            body_len += 16
+
+        buf = bytearray(len(head) + body_len + 16 + 32)
+        buf[:len(head)] = head
+        # random padding is drawn from one pool instead of one os.urandom call per field
+        pool = self._urandom(padding)
+        pool_offset = 0
+        pack_into = struct.pack_into
+        update = hmac_checker.update
+        offset = len(head)
+        boundaries = []
+        for (count, fields) in groups:
+            for field in fields:
+                raw_len = field.raw_len
+                raw_value = field.view()
+
+                assert len(raw_value) == raw_len
+
+                pack_into("<LB", buf, offset, raw_len, field.raw_type)
+                buf[offset+5:offset+5+raw_len] = raw_value
+                update(raw_value)
+                pad_count = (raw_len + 5 + 15) // 16 * 16 - 5 - raw_len
+                buf[offset+5+raw_len:offset+5+raw_len+pad_count] = pool[pool_offset:pool_offset+pad_count]
+                pool_offset += pad_count
+                offset += 5 + raw_len + pad_count
+            pack_into("<LB", buf, offset, 0, 0xff)
+            buf[offset+5:offset+16] = pool[pool_offset:pool_offset+11]
+            pool_offset += 11
+            offset += 16
+            if count == 0 or count % self.CHECKPOINT_INTERVAL == 0 or count == record_count:
+                boundaries.append((count, offset, hmac_checker.copy()))
+        return (buf, offset, boundaries)
+
+    def _field_tlv(self, field):
+        """
+        Return the unencrypted TLV block(s) of one field, padded to a multiple of 16 bytes.
         """
-        if (field is None):
-            filehandle.write(b"PWS3-EOFPWS3-EOF")
-            return
 
         assert len(field.raw_value) == field.raw_len
 
@@ -364,9 +1011,18 @@ class Vault(object):
             pad_count = 16 - (len(data) % 16)
             data += self._urandom(pad_count)
 
-        data = cipher.encrypt(data)
+        return data
 
-        filehandle.write(data)
+    def wipe_keys(self):
+        """
+        Overwrite the key material kept for this session. The next save stretches the password again.
+        """
+        if self._keys is not None:
+            self._keys.wipe()
+            self._keys = None
+        # checkpoints of the last save hold HMAC states keyed with L
+        self._saved = None
+        self._journal = None
 
     @staticmethod
     def create(password, filename):
@@ -376,6 +1032,111 @@ class Vault(object):
         vault = Vault(password)
         vault.write_to_file(filename, password)
 
+    # number of Records between two save checkpoints; see SavedState
+    CHECKPOINT_INTERVAL = 64
+
+    # rough number of encrypted bytes per record, used by peek() if it finds no complete record to go by
+    ESTIMATED_RECORD_BYTES = 208
+
+    # number of bytes of records peek() decrypts to estimate the record count from
+    PEEK_SAMPLE_SIZE = 65536
+
+    @staticmethod
+    def peek(filename, password):
+        """
+        Return metadata of the Vault stored in the given file, decrypting only its header and first records.
+
+        The password is verified, but the records are neither parsed nor
+        checked against the file's HMAC. The returned dict contains the
+        header's "version", "last_save" (a Unix timestamp) and "what_saved",
+        plus "iterations", "file_size", "estimated_records" and "header" (the
+        raw header fields, by type). Header values missing from the file are
+        None. The record count is extrapolated from the sizes of the records
+        in the first PEEK_SAMPLE_SIZE bytes, so it is only exact for Vaults
+        whose records all fit in there.
+        """
+
+        assert type(password) == six.text_type
+
+        vault = Vault.__new__(Vault)
+        # so that wipe_keys() works even if reading the preamble fails early
+        vault._keys = None
+        vault._saved = None
+        vault._journal = None
+        file_size = os.path.getsize(filename)
+        # everything between the preamble and the EOF block and HMAC
+        fields_size = max(0, file_size - 152 - 16 - 32)
+        header = Vault.Header()
+        header_size = None
+        sampled_records = 0
+        sampled_size = 0
+        try:
+            with open(filename, 'rb') as filehandle:
+                vault._read_preamble(filehandle.read(152), password.encode('utf_8', 'replace'))
+                cipher = vault._keys.new_cbc(vault.f_iv)
+                plaintext = b""
+                offset = 0
+                while True:
+                    if offset + 16 <= len(plaintext):
+                        (raw_type, raw_len, field_end) = Vault._field_at(plaintext, offset)
+                        if field_end <= len(plaintext):
+                            if header_size is None:
+                                if raw_type == 0xff:
+                                    header_size = field_end
+                                else:
+                                    header.add_raw_field(Vault.Field(raw_type, raw_len, plaintext[offset+5:offset+5+raw_len]))
+                            elif raw_type == 0xff:
+                                sampled_records += 1
+                                sampled_size = field_end - header_size
+                            offset = field_end
+                            continue
+                    if header_size is not None and len(plaintext) - header_size >= Vault.PEEK_SAMPLE_SIZE:
+                        break
+                    data = filehandle.read(min(4096, fields_size - len(plaintext)))
+                    data = data[:len(data) // 16 * 16]
+                    if not data:
+                        if header_size is None:
+                            raise Vault.VaultFormatError("EOF encountered when parsing record field")
+                        break
+                    plaintext += cipher.decrypt(data)
+        finally:
+            vault.wipe_keys()
+
+        def raw_value(raw_id):
+            field = header.raw_fields.get(raw_id)
+            return field.raw_value if field is not None else None
+
+        version = raw_value(0x00)
+        if version is not None and len(version) == 2:
+            version = "%d.%02d" % (six.indexbytes(version, 1), six.indexbytes(version, 0))
+        last_save = raw_value(0x04)
+        if last_save is not None:
+            if len(last_save) == 4:
+                last_save = struct.unpack("<L", last_save)[0]
+            elif len(last_save) == 8:
+                # older files store the time as hex digits
+                last_save = int(last_save, 16)
+        what_saved = raw_value(0x06)
+        if what_saved is not None:
+            what_saved = what_saved.decode('utf_8', 'replace')
+
+        records_size = max(0, fields_size - header_size)
+        if sampled_size == records_size:
+            estimated_records = sampled_records
+        elif sampled_records:
+            estimated_records = int(round(records_size * sampled_records / float(sampled_size)))
+        else:
+            estimated_records = int(round(records_size / float(Vault.ESTIMATED_RECORD_BYTES)))
+        return {
+            "version": version,
+            "last_save": last_save,
+            "what_saved": what_saved,
+            "iterations": vault.f_iter,
+            "file_size": file_size,
+            "estimated_records": estimated_records,
+            "header": header.raw_fields,
+        }
+
     def _create_empty(self, password):
 
         assert type(password) == six.binary_type
@@ -383,172 +1144,683 @@ class Vault(object):
         self.f_tag = b'PWS3'
         self.f_salt = Vault._urandom(32)
         self.f_iter = 2048
-        stretched_password = self._stretch_password(password, self.f_salt, self.f_iter)
-        self.f_sha_ps = hashlib.sha256(stretched_password).digest()
+        self._keys = self.KeyMaterial(password, self.f_salt, self.f_iter)
+        self.f_sha_ps = self._keys.sha_ps
 
-        cipher = TwofishECB(stretched_password)
+        cipher = self._keys.ecb
         self.f_b1 = cipher.encrypt(Vault._urandom(16))
         self.f_b2 = cipher.encrypt(Vault._urandom(16))
         self.f_b3 = cipher.encrypt(Vault._urandom(16))
         self.f_b4 = cipher.encrypt(Vault._urandom(16))
-        key_k = cipher.decrypt(self.f_b1) + cipher.decrypt(self.f_b2)
-        key_l = cipher.decrypt(self.f_b3) + cipher.decrypt(self.f_b4)
+        self._keys.set_blocks(self.f_b1, self.f_b2, self.f_b3, self.f_b4)
 
         self.f_iv = Vault._urandom(16)
 
-        hmac_checker = HMAC(key_l, b"", hashlib.sha256)
-        cipher = TwofishCBC(key_k, self.f_iv)
+        hmac_checker = self._keys.new_hmac()
 
         # No records yet
 
         self.f_hmac = hmac_checker.digest()
 
-    def _read_from_file(self, filename, password):
+    def _read_preamble(self, data, password, key_material=None):
         """
-        Initialize all class members by loading the contents of a Vault stored in the given file.
+        Initialize the members stored in front of the encrypted fields from the given file contents, and check the password.
         """
 
-        assert type(password) == six.binary_type
-
-        filehandle = open(filename, 'rb')
-
         # read boilerplate
 
-        self.f_tag = filehandle.read(4)  # TAG: magic tag
+        self.f_tag = data[0:4]  # TAG: magic tag
         if (self.f_tag != b'PWS3'):
             raise self.VaultVersionError("Not a PasswordSafe V3 file")
+        if len(data) < 152:
+            raise self.VaultFormatError("EOF encountered when parsing file preamble")
 
-        self.f_salt = filehandle.read(32)  # SALT: SHA-256 salt
-        self.f_iter = struct.unpack("<L", filehandle.read(4))[0]  # ITER: SHA-256 keystretch iterations
-        stretched_password = self._stretch_password(password, self.f_salt, self.f_iter)  # P': the stretched key
-        my_sha_ps = hashlib.sha256(stretched_password).digest()
+        self.f_salt = data[4:36]  # SALT: SHA-256 salt
+        self.f_iter = struct.unpack("<L", data[36:40])[0]  # ITER: SHA-256 keystretch iterations
+        if key_material is not None and key_material.matches(password, self.f_salt, self.f_iter):
+            self._keys = key_material
+        else:
+            self._keys = self.KeyMaterial(password, self.f_salt, self.f_iter)  # P': the stretched key
+        my_sha_ps = self._keys.sha_ps
 
-        self.f_sha_ps = filehandle.read(32) # H(P'): SHA-256 hash of stretched passphrase
+        self.f_sha_ps = data[40:72] # H(P'): SHA-256 hash of stretched passphrase
         if (self.f_sha_ps != my_sha_ps):
             raise self.BadPasswordError("Wrong password")
 
-        self.f_b1 = filehandle.read(16)  # B1
-        self.f_b2 = filehandle.read(16)  # B2
-        self.f_b3 = filehandle.read(16)  # B3
-        self.f_b4 = filehandle.read(16)  # B4
+        self.f_b1 = data[72:88]  # B1
+        self.f_b2 = data[88:104]  # B2
+        self.f_b3 = data[104:120]  # B3
+        self.f_b4 = data[120:136]  # B4
+
+        self._keys.set_blocks(self.f_b1, self.f_b2, self.f_b3, self.f_b4)
 
-        cipher = TwofishECB(stretched_password)
-        key_k = cipher.decrypt(self.f_b1) + cipher.decrypt(self.f_b2)
-        key_l = cipher.decrypt(self.f_b3) + cipher.decrypt(self.f_b4)
+        self.f_iv = data[136:152]  # IV: initialization vector of Twofish CBC
+
+    def _read_from_file(self, filename, password, key_material=None):
+        """
+        Initialize all class members by loading the contents of a Vault stored in the given file.
+        """
+
+        assert type(password) == six.binary_type
 
-        self.f_iv = filehandle.read(16)  # IV: initialization vector of Twofish CBC
+        # read the whole file at once, then decrypt all fields in one go
 
-        hmac_checker = HMAC(key_l, b"", hashlib.sha256)
-        cipher = TwofishCBC(key_k, self.f_iv)
+        with open(filename, 'rb') as filehandle:
+            data = filehandle.read()
+
+        self._read_preamble(data, password, key_material)
+
+        hmac_checker = self._keys.new_hmac()
+        cipher = self._keys.new_cbc(self.f_iv)
+
+        # find the (unencrypted) EOF block that ends the encrypted fields
+
+        fields_end = data.find(b"PWS3-EOFPWS3-EOF", 152)
+        while (fields_end != -1) and ((fields_end - 152) % 16 != 0):
+            fields_end = data.find(b"PWS3-EOFPWS3-EOF", fields_end + 1)
+        if fields_end == -1:
+            raise self.VaultFormatError("EOF encountered when parsing record field")
+        plaintext = memoryview(cipher.decrypt(data[152:fields_end]))
+        fields = self._parse_tlv(plaintext)
+        from_buffer = self.Field.from_buffer
+
+        checkpoints = []
+
+        def checkpoint(offset):
+            # offset is that of the value of an end-of-record field, which is one block long
+            file_offset = 152 + offset - 5 + 16
+            checkpoints.append((len(self.records), file_offset, data[file_offset-16:file_offset], hmac_checker.copy()))
 
         # read header
 
-        while (True):
-            field = self._read_field_tlv(filehandle, cipher)
-            if not field:
-                break
-            if field.raw_type == 0xff:
+        for (raw_type, offset, raw_len) in fields:
+            if raw_type == 0xff:
+                checkpoint(offset)
                 break
-            self.header.add_raw_field(field)
-            hmac_checker.update(field.raw_value)
+            self.header.add_raw_field(from_buffer(raw_type, raw_len, plaintext, offset))
+            hmac_checker.update(plaintext[offset:offset + raw_len])
 
         # read fields
 
         current_record = self.Record()
-        while (True):
-            field = self._read_field_tlv(filehandle, cipher)
-            if not field:
-                break
-            if field.raw_type == 0xff:
+        offset = None
+        for (raw_type, offset, raw_len) in fields:
+            if raw_type == 0xff:
                 self.records.append(current_record)
                 current_record = self.Record()
+                if len(self.records) % self.CHECKPOINT_INTERVAL == 0:
+                    checkpoint(offset)
             else:
-                hmac_checker.update(field.raw_value)
-                current_record.add_raw_field(field)
+                hmac_checker.update(plaintext[offset:offset + raw_len])
+                current_record.add_raw_field(from_buffer(raw_type, raw_len, plaintext, offset))
+        if checkpoints and checkpoints[-1][0] != len(self.records) and not current_record.raw_fields:
+            checkpoint(offset)
 
         # read HMAC
 
-        self.f_hmac = filehandle.read(32)  # HMAC: used to verify Vault's integrity
+        self.f_hmac = data[fields_end+16:fields_end+48]  # HMAC: used to verify Vault's integrity
 
         my_hmac = hmac_checker.digest()
         if (self.f_hmac != my_hmac):
             raise self.VaultFormatError("File integrity check failed")
 
-        filehandle.close()
+        self._saved = self.SavedState(self, filename, len(data), hashlib.sha256(data).digest(), checkpoints)
+        self._replay_journal(filename)
+        self._mark_synced()
+
+    # number of bytes iter_records() reads from the file at a time
+    STREAM_CHUNK_SIZE = 65536
 
-    def write_to_file(self, filename, password):
+    @staticmethod
+    def iter_records(filename, password, verify_first=False):
         """
-        Store contents of this Vault into a file.
+        Return an iterator over the Records of the Vault stored in the given file, decrypting the file as they are needed.
+
+        Only a chunk of the file and the Record being parsed are kept in
+        memory, so Vaults of any size can be gone through in bounded memory.
+        Edits from the journal next to the file are applied on the way. The
+        password is checked right away, but the file's HMAC only once all
+        Records have been read: the iterator then raises VaultFormatError if it
+        does not match, after all Records have been yielded. With
+        verify_first=True, Records are only yielded once the HMAC has been
+        verified, at the cost of keeping all of them in memory until then.
         """
 
         assert type(password) == six.text_type
 
+        vault = Vault.__new__(Vault)
+        with open(filename, 'rb') as filehandle:
+            vault._read_preamble(filehandle.read(152), password.encode('utf_8', 'replace'))
+            # the HMAC at the end of the file tells whether the journal belongs to it
+            filehandle.seek(0, os.SEEK_END)
+            filehandle.seek(max(152, filehandle.tell() - 32))
+            file_hmac = filehandle.read(32)
+        records = vault._stream_records(filename, file_hmac)
+        if verify_first:
+            return iter(list(records))
+        return records
+
+    def _stream_records(self, filename, file_hmac):
+        """
+        Yield the Records of the given file, whose preamble has been read already, then wipe the keys.
+        """
+        try:
+            (edits, added) = self._journal_edits(filename, file_hmac)
+            journal_applied = bool(edits or added)
+            hmac_checker = self._keys.new_hmac()
+            stream = TwofishCBCStream(bytes(self._keys.key_k), self.f_iv, decrypt=True)
+            plaintext = bytearray()  # decrypted fields not parsed yet
+            parsed = 0  # offset of plaintext in the encrypted fields
+            consumed = 0  # number of bytes after the preamble fed to the stream
+            recent = b""  # the last bytes fed, in case the EOF block straddles two chunks
+            fields_end = None
+            in_header = True
+            current_record = self.Record()
+            with open(filename, 'rb') as filehandle:
+                filehandle.seek(152)
+                while fields_end is None:
+                    data = filehandle.read(self.STREAM_CHUNK_SIZE)
+                    if not data:
+                        raise self.VaultFormatError("EOF encountered when parsing record field")
+
+                    # find the (unencrypted) EOF block that ends the encrypted fields
+                    window = recent + data
+                    window_start = consumed - len(recent)
+                    found = window.find(b"PWS3-EOFPWS3-EOF")
+                    while (found != -1) and ((window_start + found) % 16 != 0):
+                        found = window.find(b"PWS3-EOFPWS3-EOF", found + 1)
+                    if found != -1:
+                        fields_end = window_start + found
+                        trailer = window[found+16:]
+                        trailer += filehandle.read(max(0, 32 - len(trailer)))
+                    plaintext += stream.update(data)
+                    consumed += len(data)
+                    recent = window[-15:]
+
+                    # parse all complete fields, keeping a trailing partial one for the next chunk
+                    end = len(plaintext) if fields_end is None else fields_end - parsed
+                    offset = 0
+                    while offset + 16 <= end:
+                        (raw_type, raw_len, field_end) = self._field_at(plaintext, offset)
+                        if field_end > end:
+                            break
+                        if raw_type != 0xff:
+                            raw_value = bytes(plaintext[offset+5:offset+5+raw_len])
+                            hmac_checker.update(raw_value)
+                            if not in_header:
+                                current_record.add_raw_field(self.Field(raw_type, raw_len, raw_value))
+                        elif in_header:
+                            in_header = False
+                        else:
+                            record = edits.pop(current_record.uuid, current_record) if edits else current_record
+                            if record is not None:
+                                yield record
+                            current_record = self.Record()
+                        offset = field_end
+                    del plaintext[:offset]
+                    parsed += offset
+            if parsed != fields_end:
+                raise self.VaultFormatError("EOF encountered when parsing record field")
+
+            if (trailer[:32] != hmac_checker.digest()):
+                raise self.VaultFormatError("File integrity check failed")
+            if journal_applied and trailer[:32] != file_hmac:
+                # the journal was checked against what turned out not to be the file's HMAC
+                raise self.VaultFormatError("File integrity check failed")
+
+            # Records added by the journal
+            for record in itertools.chain(edits.values(), added.values()):
+                if record is not None:
+                    yield record
+        finally:
+            self.wipe_keys()
+
+    def _journal_edits(self, filename, file_hmac):
+        """
+        Return the edits of the journal next to the given Vault file, if it belongs to a file with the given HMAC, as two dicts keyed by Record UUID.
+
+        The first maps the UUIDs of Records to replace to their new version,
+        or to None if they were deleted; entries left over once the file has
+        been read are Records the file does not contain. The second holds
+        Records that were deleted and then added again, which go to the end.
+        """
+        edits = OrderedDict()
+        added = OrderedDict()
+        (entries, length) = self._read_journal(filename, file_hmac)
+        for plaintext in entries:
+            (operation, record_uuid, record) = self._journal_record(plaintext)
+            if operation == self.JOURNAL_DELETE:
+                edits[record_uuid] = None
+                added.pop(record_uuid, None)
+            elif record_uuid in edits and edits[record_uuid] is None or record_uuid in added:
+                added[record_uuid] = record
+            else:
+                edits[record_uuid] = record
+        return (edits, added)
+
+    def _reusable_prefix(self, filename):
+        """
+        Return the last save checkpoint before the first changed Record and the file contents up to it, or None.
+        """
+        if self._saved is None:
+            return None
+        count = self._saved.unchanged_records(self, filename)
+        if count is None:
+            return None
+        checkpoint = [checkpoint for checkpoint in self._saved.checkpoints if checkpoint[0] <= count][-1]
+        try:
+            with open(filename, 'rb') as filehandle:
+                data = filehandle.read()
+        except (IOError, OSError):
+            return None
+        # make sure nobody else changed the file in the meantime
+        if (len(data), hashlib.sha256(data).digest()) != (self._saved.length, self._saved.digest):
+            return None
+        return (checkpoint, data[:checkpoint[1]])
+
+    def _stamp_header(self):
+        """
+        Set the header's last save time and application fields.
+        """
         _last_save = struct.pack("<L", int(time.time()))
         self.header.raw_fields[0x04] = self.Field(0x04, len(_last_save), _last_save)
         _what_saved = "Loxodo 0.0-git".encode("utf_8", "replace")
         self.header.raw_fields[0x06] = self.Field(0x06, len(_what_saved), _what_saved)
 
-        # write to temporary file first
-        (osfilehandle, tmpfilename) = tempfile.mkstemp('.part', os.path.basename(filename) + ".", os.path.dirname(filename), text=False)
-        filehandle = os.fdopen(osfilehandle, "wb")
+    def _preamble(self):
+        """
+        Return the unencrypted boilerplate in front of the encrypted fields.
+        """
+        return (self.f_tag + self.f_salt + struct.pack("<L", self.f_iter) + self.f_sha_ps
+                + self.f_b1 + self.f_b2 + self.f_b3 + self.f_b4 + self.f_iv)
 
-        # FIXME: choose new SALT, B1-B4, IV values on each file write? Conflicting Specs!
+    def write_to_file(self, filename, password, paranoid=False, incremental=False):
+        """
+        Store contents of this Vault into a file.
 
-        # write boilerplate
+        The written file is checked by comparing its contents with a hash of the
+        bytes that were written. With paranoid=True, it is also parsed and
+        decrypted again, and its HMAC compared with the one just computed.
+
+        With incremental=True, and if the file is the one this Vault was last
+        read from or written to, the encrypted header and all Records up to the
+        last checkpoint before the first changed Record are copied from the
+        file instead of being encrypted again. The header's last save time is
+        then left as it was.
+        """
 
-        filehandle.write(self.f_tag)
-        filehandle.write(self.f_salt)
-        filehandle.write(struct.pack("<L", self.f_iter))
+        assert type(password) == six.text_type
 
-        stretched_password = self._stretch_password(password.encode('utf_8', 'replace'), self.f_salt, self.f_iter)
-        self.f_sha_ps = hashlib.sha256(stretched_password).digest()
-        filehandle.write(self.f_sha_ps)
+        # only stretch the password again if it (or the salt) changed since it was last stretched
+        raw_password = password.encode('utf_8', 'replace')
+        if self._keys is None or not self._keys.matches(raw_password, self.f_salt, self.f_iter):
+            self.wipe_keys()
+            self._keys = self.KeyMaterial(raw_password, self.f_salt, self.f_iter)
+        self._keys.set_blocks(self.f_b1, self.f_b2, self.f_b3, self.f_b4)
+        self.f_sha_ps = self._keys.sha_ps
 
-        filehandle.write(self.f_b1)
-        filehandle.write(self.f_b2)
-        filehandle.write(self.f_b3)
-        filehandle.write(self.f_b4)
+        prefix = self._reusable_prefix(filename) if incremental else None
 
-        cipher = TwofishECB(stretched_password)
-        key_k = cipher.decrypt(self.f_b1) + cipher.decrypt(self.f_b2)
-        key_l = cipher.decrypt(self.f_b3) + cipher.decrypt(self.f_b4)
+        if prefix is None:
+            self._stamp_header()
 
-        filehandle.write(self.f_iv)
+        records = list(self.records)
 
-        hmac_checker = HMAC(key_l, b"", hashlib.sha256)
-        cipher = TwofishCBC(key_k, self.f_iv)
+        if prefix is not None:
+            # keep everything up to the checkpoint and continue from its CBC and HMAC state
+            ((start, offset, state, hmac_state), head) = prefix
+            cipher = self._keys.new_cbc(state)
+            hmac_checker = hmac_state.copy()
+            checkpoints = [checkpoint for checkpoint in self._saved.checkpoints if checkpoint[0] <= start]
+            groups = []
+        else:
+            start = 0
 
-        end_of_record = self.Field(0xff, 0, b"")
+            # FIXME: choose new SALT, B1-B4, IV values on each file write? Conflicting Specs!
 
-        for field in self.header.raw_fields.values():
-            self._write_field_tlv(filehandle, cipher, field)
-            hmac_checker.update(field.raw_value)
-        self._write_field_tlv(filehandle, cipher, end_of_record)
-        hmac_checker.update(end_of_record.raw_value)
+            head = self._preamble()
+            cipher = self._keys.new_cbc(self.f_iv)
+            hmac_checker = self._keys.new_hmac()
+            checkpoints = []
+            groups = [(0, list(self.header.raw_fields.values()))]
+        groups.extend((count, list(records[count - 1].raw_fields.values())) for count in range(start + 1, len(records) + 1))
 
-        for record in self.records:
-            for field in record.raw_fields.values():
-                self._write_field_tlv(filehandle, cipher, field)
-                hmac_checker.update(field.raw_value)
-            self._write_field_tlv(filehandle, cipher, end_of_record)
-            hmac_checker.update(end_of_record.raw_value)
+        (buf, body_end, boundaries) = self._serialize(head, groups, hmac_checker, len(records))
 
-        self._write_field_tlv(filehandle, cipher, None)
+        # encrypt all fields in one go, then take CBC states for the checkpoints from the ciphertext
+        body = memoryview(buf)[len(head):body_end]
+        cipher.encrypt_into(body, body)
+        for (count, offset, hmac_state) in boundaries:
+            checkpoints.append((count, offset, bytes(buf[offset-16:offset]), hmac_state))
 
+        buf[body_end:body_end+16] = b"PWS3-EOFPWS3-EOF"
         self.f_hmac = hmac_checker.digest()
-        filehandle.write(self.f_hmac)
+        buf[body_end+16:] = self.f_hmac
+
+        # write to temporary file first
+        (tmpfilename, filehandle) = _create_temporary(filename)
+        filehandle.write(buf)
         filehandle.close()
 
         try:
-            tmpvault = Vault(password, filename=tmpfilename)
-        except RuntimeError:
+            if _file_digest(tmpfilename) != (filehandle.length, filehandle.sha.digest()):
+                raise self.VaultFormatError("File integrity check failed")
+            if paranoid:
+                tmpvault = Vault(password, filename=tmpfilename, key_material=self._keys)
+                if tmpvault.f_hmac != self.f_hmac:
+                    raise self.VaultFormatError("File integrity check failed")
+        except (RuntimeError, IOError, OSError):
             os.remove(tmpfilename)
             raise self.VaultFormatError("File integrity check failed")
 
         # after writing the temporary file, replace the original file with it
+        _replace_file(tmpfilename, filename)
+
+        self._saved = self.SavedState(self, filename, filehandle.length, filehandle.sha.digest(), checkpoints)
+        self._mark_synced()
+
+        # the file now contains all edits of the journal, if any
+        self._journal = (0, 0)
+
+    # followed by the HMAC of the Vault file the journal belongs to
+    JOURNAL_MAGIC = b"LXJ2"
+
+    # write_journal() saves the whole Vault instead once the journal grows beyond this many bytes
+    JOURNAL_COMPACT_SIZE = 1048576
+
+    # journal operations
+    JOURNAL_PUT = 1
+    JOURNAL_DELETE = 2
+
+    @staticmethod
+    def journal_filename(filename):
+        """
+        Return the name of the edit journal kept next to the given Vault file.
+        """
+        return filename + ".journal"
+
+    def _mark_synced(self):
+        self._synced = OrderedDict((id(record), (record, record.revision, record.uuid)) for record in self.records)
+
+    def _journal_keys(self):
+        """
+        Return the keys to encrypt and to authenticate journal entries with, derived from L.
+        """
+        key_l = bytes(self._keys.key_l)
+        return (HMAC(key_l, b"Loxodo journal encryption", hashlib.sha256).digest(),
+                HMAC(key_l, b"Loxodo journal authentication", hashlib.sha256).digest())
+
+    def _replay_journal(self, filename):
+        """
+        Apply the edits of the journal next to the given Vault file, if it was written for the file's current contents.
+        """
+        (entries, length) = self._read_journal(filename, self.f_hmac)
+        for plaintext in entries:
+            self._apply_journal_entry(plaintext)
+        if length is not None:
+            self._journal = (len(entries), length)
+
+    def _read_journal(self, filename, file_hmac):
+        """
+        Return the decrypted entries of the journal next to the given Vault file, and the journal's length.
+
+        A journal for a file with another HMAC than the given one (i.e. with
+        other contents) is left over from a save that was interrupted after
+        writing the file, and is ignored: no entries and a length of None are
+        returned. An incomplete last entry (from an interrupted journal write)
+        is ignored as well.
+        """
         try:
-            os.remove(filename)
+            with open(self.journal_filename(filename), 'rb') as filehandle:
+                data = filehandle.read()
+        except (IOError, OSError):
+            return ([], 0)
+        preamble = self.JOURNAL_MAGIC + file_hmac
+        if data[:len(preamble)] != preamble:
+            return ([], None)
+        (enc_key, mac_key) = self._journal_keys()
+        offset = len(preamble)
+        entries = []
+        while offset + 4 <= len(data):
+            length = struct.unpack_from("<L", data, offset)[0]
+            entry_end = offset + 4 + 16 + length + 32
+            if entry_end > len(data):
+                break
+            body = data[offset:entry_end-32]
+            mac = HMAC(mac_key, preamble + struct.pack("<Q", len(entries)) + body, hashlib.sha256).digest()
+            if mac != data[entry_end-32:entry_end]:
+                raise self.VaultFormatError("Journal integrity check failed")
+            entries.append(TwofishCBC(enc_key, body[4:20]).decrypt(body[20:]))
+            offset = entry_end
+        return (entries, offset)
+
+    def _journal_record(self, plaintext):
+        """
+        Return the operation, Record UUID and (for JOURNAL_PUT) new Record of a decrypted journal entry.
+        """
+        operation = six.indexbytes(plaintext, 0)
+        record_uuid = uuid.UUID(bytes_le=plaintext[1:17])
+        if operation == self.JOURNAL_DELETE:
+            return (operation, record_uuid, None)
+        record = self.Record()
+        for (raw_type, offset, raw_len) in self._parse_tlv(plaintext[32:]):
+            record.add_raw_field(self.Field(raw_type, raw_len, plaintext[32+offset:32+offset+raw_len]))
+        return (operation, record_uuid, record)
+
+    def _apply_journal_entry(self, plaintext):
+        (operation, record_uuid, record) = self._journal_record(plaintext)
+        if operation == self.JOURNAL_DELETE:
+            old_record = self.records.get(record_uuid)
+            if old_record is not None:
+                self.records.remove(old_record)
+        else:
+            self.records.put(record)
+
+    def _journal_entry(self, enc_key, mac_key, preamble, sequence, operation, record_uuid, fields):
+        plaintext = struct.pack("<B", operation) + record_uuid.bytes_le + self._urandom(15)
+        plaintext += b"".join(self._field_tlv(field) for field in fields)
+        init_vec = self._urandom(16)
+        body = struct.pack("<L", len(plaintext)) + init_vec + TwofishCBC(enc_key, init_vec).encrypt(plaintext)
+        return body + HMAC(mac_key, preamble + struct.pack("<Q", sequence) + body, hashlib.sha256).digest()
+
+    def write_journal(self, filename, password):
+        """
+        Store the changes made since this Vault was last read or saved in the edit journal next to the given file.
+
+        Only added, changed and deleted Records are written, each as a small
+        encrypted and authenticated entry appended to the journal; the Vault
+        file itself is not touched, so this takes time proportional to the
+        changes rather than to the size of the Vault. The journal is replayed
+        when the file is opened, and removed by the next write_to_file(). When
+        the journal would grow beyond JOURNAL_COMPACT_SIZE, or the changes can
+        not be expressed as journal entries (Records without or with changed
+        UUIDs, changes to other than the first of several Records with the same
+        UUID, a new password, another file), the whole Vault is saved instead.
+        """
+
+        assert type(password) == six.text_type
+
+        raw_password = password.encode('utf_8', 'replace')
+        if (self._keys is None or not self._keys.matches(raw_password, self.f_salt, self.f_iter)
+                or self._saved is None or self._saved.filename != os.path.abspath(filename) or self._journal is None):
+            return self.write_to_file(filename, password, incremental=True)
+
+        operations = []
+        present = set()
+        for record in self.records:
+            present.add(id(record))
+            synced = self._synced.get(id(record))
+            if synced is not None and synced[1] == record.revision:
+                continue
+            if record.uuid is None or self.records.get(record.uuid) is not record or (synced is not None and synced[2] != record.uuid):
+                return self.write_to_file(filename, password, incremental=True)
+            operations.append((self.JOURNAL_PUT, record))
+        # deletions are replayed by UUID, which only finds the first of several Records with the same UUID
+        first_synced = {}
+        for (record_id, (record, revision, record_uuid)) in self._synced.items():
+            first_synced.setdefault(record_uuid, record_id)
+        for (record_id, (record, revision, record_uuid)) in self._synced.items():
+            if record_id not in present:
+                if record_uuid is None or first_synced[record_uuid] != record_id:
+                    return self.write_to_file(filename, password, incremental=True)
+                operations.insert(0, (self.JOURNAL_DELETE, record_uuid))
+        if not operations:
+            return
+
+        journal_filename = self.journal_filename(filename)
+        (entries, length) = self._journal
+        try:
+            current_length = os.path.getsize(journal_filename)
         except OSError:
-            pass
-        os.rename(tmpfilename, filename)
+            current_length = 0
+        if current_length != length:
+            # somebody else changed the journal, or its last write was interrupted
+            return self.write_to_file(filename, password, incremental=True)
+
+        (enc_key, mac_key) = self._journal_keys()
+        preamble = self.JOURNAL_MAGIC + self.f_hmac
+        data = b"" if current_length else preamble
+        for (operation, item) in operations:
+            if operation == self.JOURNAL_DELETE:
+                data += self._journal_entry(enc_key, mac_key, preamble, entries, operation, item, [])
+            else:
+                data += self._journal_entry(enc_key, mac_key, preamble, entries, operation, item.uuid, item.raw_fields.values())
+            entries += 1
+        if current_length + len(data) > self.JOURNAL_COMPACT_SIZE:
+            return self.write_to_file(filename, password, incremental=True)
+
+        with open(journal_filename, 'ab') as filehandle:
+            filehandle.write(data)
+            filehandle.flush()
+            os.fsync(filehandle.fileno())
+        self._journal = (entries, current_length + len(data))
+
+        for (operation, item) in operations:
+            if operation == self.JOURNAL_PUT:
+                self._synced[id(item)] = (item, item.revision, item.uuid)
+        for record_id in [record_id for record_id in self._synced if record_id not in present]:
+            del self._synced[record_id]
+
+
+class VaultWriter(object):
+    """
+    Writes a new Vault file from Records that are handed in one at a time.
+
+    The preamble and header are written when the writer is created; Records
+    are then encrypted and added to the HMAC in batches of BATCH_RECORDS as
+    they come in, and are not kept afterwards, so a Vault of any size can be
+    written in bounded memory, e.g. from Vault.iter_records() of another file.
+    close() adds the EOF block and HMAC and replaces the given file with the
+    new one; until then, everything goes to a temporary file next to it. Use
+    as a context manager to close on success and discard the temporary file
+    if an exception is raised:
+
+        with VaultWriter(filename, password) as writer:
+            writer.write_records(records)
+
+    Header fields (e.g. those returned by Vault.peek()) may be passed in to be
+    copied to the new file; its last save time and application are updated.
+    """
+
+    # number of Records that are encrypted and written at once
+    BATCH_RECORDS = 256
+
+    def __init__(self, filename, password, header_fields=None):
+
+        assert type(password) == six.text_type
+
+        self.filename = filename
+        self.count = 0
+        self._vault = Vault(password)
+        if header_fields is not None:
+            for (raw_id, field) in header_fields.items():
+                self._vault.header.raw_fields[raw_id] = field
+        self._vault._stamp_header()
+        self._cipher = self._vault._keys.new_cbc(self._vault.f_iv)
+        self._hmac_checker = self._vault._keys.new_hmac()
+        self._groups = []
+
+        (self._tmpfilename, self._filehandle) = _create_temporary(filename)
+        try:
+            self._filehandle.write(self._vault._preamble())
+            self._write_groups([(0, list(self._vault.header.raw_fields.values()))])
+        except:
+            self.abort()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
 
+    def _write_groups(self, groups):
+        (buf, body_end, boundaries) = self._vault._serialize(b"", groups, self._hmac_checker, None)
+        body = memoryview(buf)[:body_end]
+        self._cipher.encrypt_into(body, body)
+        self._filehandle.write(body)
+
+    def write_record(self, record):
+        """
+        Add the given Record to the file.
+        """
+        if self._filehandle is None:
+            raise RuntimeError("VaultWriter already closed")
+        self.count += 1
+        self._groups.append((self.count, list(record.raw_fields.values())))
+        if len(self._groups) >= self.BATCH_RECORDS:
+            self.flush()
+
+    def write_records(self, records):
+        """
+        Add all Records of the given iterable to the file.
+        """
+        for record in records:
+            self.write_record(record)
+
+    def flush(self):
+        """
+        Encrypt and write all Records that were added but not written yet.
+        """
+        if self._groups:
+            self._write_groups(self._groups)
+            self._groups = []
+
+    def close(self):
+        """
+        Write the remaining Records, the EOF block and the HMAC, then replace the target file with the new one.
+        """
+        if self._filehandle is None:
+            raise RuntimeError("VaultWriter already closed")
+        try:
+            self.flush()
+            self._filehandle.write(b"PWS3-EOFPWS3-EOF")
+            self._filehandle.write(self._hmac_checker.digest())
+            self._filehandle.close()
+            if _file_digest(self._tmpfilename) != (self._filehandle.length, self._filehandle.sha.digest()):
+                raise Vault.VaultFormatError("File integrity check failed")
+        except:
+            self.abort()
+            raise
+        self._filehandle = None
+
+        # after writing the temporary file, replace the original file with it
+        _replace_file(self._tmpfilename, self.filename)
+        self._vault.wipe_keys()
+
+    def abort(self):
+        """
+        Discard the temporary file and leave the target file as it was.
+        """
+        if self._filehandle is not None:
+            self._filehandle.filehandle.close()
+            self._filehandle = None
+            try:
+                os.remove(self._tmpfilename)
+            except OSError:
+                pass
+        self._vault.wipe_keys()
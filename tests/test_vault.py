@@ -0,0 +1,113 @@
+#
+# Loxodo -- Password Safe V3 compatible Password Vault
+# Copyright (C) 2008 Christoph Sommer <mail@christoph-sommer.de>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+"""
+Round trips through the edit journal and incremental saves.
+
+Run with "python -m pytest tests" from the top-level directory.
+"""
+
+import os
+
+from src.vault import Vault
+
+PASSWORD = u"test"
+
+
+def make_vault(filename, titles):
+    """
+    Write a Vault with one Record per title to the given file and return it.
+    """
+    vault = Vault(PASSWORD)
+    for title in titles:
+        record = Vault.Record.create()
+        record.title = title
+        vault.records.append(record)
+    vault.write_to_file(filename, PASSWORD)
+    return Vault(PASSWORD, filename=filename)
+
+
+def titles(records):
+    return [record.title for record in records]
+
+
+def reopened_titles(filename):
+    """
+    Return the titles read back by both Vault() and Vault.iter_records(), checking that they agree.
+    """
+    result = titles(Vault(PASSWORD, filename=filename).records)
+    assert titles(Vault.iter_records(filename, PASSWORD)) == result
+    return result
+
+
+def test_journal_round_trip(tmp_path):
+    filename = str(tmp_path / "vault.psafe3")
+    vault = make_vault(filename, [u"first", u"second", u"third"])
+    (first, second, third) = list(vault.records)
+    second.title = u"changed"
+    vault.records.remove(first)
+    added = Vault.Record.create()
+    added.title = u"added"
+    vault.records.append(added)
+    vault.write_journal(filename, PASSWORD)
+
+    assert os.path.exists(Vault.journal_filename(filename))
+    assert reopened_titles(filename) == [u"changed", u"third", u"added"]
+
+
+def test_journal_delete_with_duplicate_uuids(tmp_path):
+    filename = str(tmp_path / "vault.psafe3")
+    vault = make_vault(filename, [u"first", u"second"])
+    (first, second) = list(vault.records)
+    second.uuid = first.uuid
+    vault.write_to_file(filename, PASSWORD)
+
+    # deleting the second of two Records with the same UUID can not be replayed by UUID
+    vault = Vault(PASSWORD, filename=filename)
+    vault.records.remove(list(vault.records)[1])
+    vault.write_journal(filename, PASSWORD)
+    assert reopened_titles(filename) == [u"first"]
+
+    # deleting the first one can
+    vault = make_vault(filename, [u"first", u"second"])
+    (first, second) = list(vault.records)
+    second.uuid = first.uuid
+    vault.write_to_file(filename, PASSWORD)
+    vault = Vault(PASSWORD, filename=filename)
+    vault.records.remove(list(vault.records)[0])
+    vault.write_journal(filename, PASSWORD)
+    assert os.path.exists(Vault.journal_filename(filename))
+    assert reopened_titles(filename) == [u"second"]
+
+
+def test_incremental_save_round_trip(tmp_path):
+    filename = str(tmp_path / "vault.psafe3")
+    count = Vault.CHECKPOINT_INTERVAL * 3
+    vault = make_vault(filename, [u"record %d" % i for i in range(count)])
+    records = list(vault.records)
+    records[-10].title = u"changed"
+    vault.records.remove(records[-5])
+    vault.write_to_file(filename, PASSWORD, incremental=True)
+
+    expected = [u"record %d" % i for i in range(count)]
+    expected[-10] = u"changed"
+    del expected[-5]
+    assert reopened_titles(filename) == expected
+    Vault(PASSWORD, filename=filename).write_to_file(filename, PASSWORD, paranoid=True)
+    assert reopened_titles(filename) == expected